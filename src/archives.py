@@ -0,0 +1,100 @@
+"""
+Read AlphaFold models straight out of proteome tar archives, without extracting them.
+
+A member-offset index (a tab-separated "<archive>.index" file next to each archive) gives random access to single models.
+Members are read with os.pread, which does not use (or move) the file offset, so archive file descriptors
+opened before a fork can be shared by the parent and its worker processes.
+"""
+
+import atexit
+import os
+import tarfile
+import typing as ty
+from pathlib import Path
+
+_ARCHIVE_FDS = {}
+
+
+class TarMember(ty.NamedTuple):
+    """
+    Location of one file inside an (uncompressed) tar archive. Picklable, so it can be sent to worker processes.
+    """
+    archive: str
+    name: str
+    offset: int
+    size: int
+
+    @property
+    def stem(self):
+        """
+        Name without its last suffix, as for pathlib.Path
+        """
+        return Path(self.name).stem
+
+    def read(self) -> bytes:
+        if self.archive not in _ARCHIVE_FDS:
+            _ARCHIVE_FDS[self.archive] = os.open(self.archive, os.O_RDONLY)
+        contents = os.pread(_ARCHIVE_FDS[self.archive], self.size, self.offset)
+        if len(contents) != self.size:
+            raise OSError(f"{self.archive}: {self.name} truncated, read {len(contents)} of {self.size} bytes")
+        return contents
+
+
+@atexit.register
+def close_archives():
+    """
+    Close the archive file descriptors opened by `TarMember.read` in this process
+    """
+    while _ARCHIVE_FDS:
+        os.close(_ARCHIVE_FDS.popitem()[1])
+
+
+def get_index_file(archive: Path) -> Path:
+    return Path(f"{archive}.index")
+
+
+def build_tar_index(archive: Path) -> ty.List[TarMember]:
+    """
+    Read the member headers of `archive` (skipping over the file contents)
+    and write the offsets of all files to its index file.
+    """
+    archive = Path(archive)
+    with tarfile.open(archive, "r:") as tar:
+        members = [TarMember(str(archive), Path(member.name).name, member.offset_data, member.size)
+                   for member in tar if member.isfile()]
+    index_file = get_index_file(archive)
+    temporary_file = index_file.with_name(f"{index_file.name}.tmp")
+    with open(temporary_file, "w") as f:
+        for member in members:
+            f.write(f"{member.name}\t{member.offset}\t{member.size}\n")
+    os.replace(temporary_file, index_file)
+    return members
+
+
+def load_tar_index(archive: Path, extension: str = ".pdb.gz") -> ty.List[TarMember]:
+    """
+    Members of `archive` ending in `extension`, sorted by name.
+    The index file is (re)built if it does not exist or is older than the archive.
+    """
+    archive = Path(archive)
+    index_file = get_index_file(archive)
+    if not index_file.exists() or index_file.stat().st_mtime < archive.stat().st_mtime:
+        members = build_tar_index(archive)
+    else:
+        with open(index_file) as f:
+            members = [TarMember(str(archive), name, int(offset), int(size))
+                       for name, offset, size in (line.rstrip("\n").split("\t") for line in f)]
+    return sorted((member for member in members if member.name.endswith(extension)), key=lambda m: m.name)
+
+
+def get_proteome_archives(root_folder: Path) -> ty.List[Path]:
+    return sorted(filename for filename in Path(root_folder).glob("UP0*.tar") if filename.is_file())
+
+
+def get_member_mapping(root_folder: Path, extension: str = ".pdb.gz") -> ty.Dict[str, TarMember]:
+    """
+    Model key (file name without .gz) to TarMember, over all UP0* proteome archives in `root_folder`.
+    """
+    return {member.stem: member
+            for archive in get_proteome_archives(root_folder)
+            for member in load_tar_index(archive, extension)}
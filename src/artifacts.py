@@ -0,0 +1,205 @@
+"""
+Versioned, lazily loaded store for the outputs of the topic modelling notebook.
+
+An artifact folder has a manifest.json listing each component and how it is stored:
+dense arrays as .npy files (memory-mapped on load), sparse matrices as a folder of CSR .npy files
+(data, indices, indptr, also memory-mapped), and everything else (fitted models) as its own pickle.
+Components are only read when first accessed, so opening a store is cheap however large its arrays are,
+and the heavy parts (e.g. the t-SNE object) are never read unless used.
+"""
+
+import json
+import os
+import pickle
+import shutil
+import time
+import typing as ty
+from pathlib import Path
+
+import numpy as np
+from scipy import sparse
+
+FORMAT_VERSION = 1
+MANIFEST_FILE = "manifest.json"
+# components with one row per key
+ROW_COMPONENTS = ("tfidf_matrix", "w_matrix", "w_matrix_norm", "reduced")
+
+
+def _save_component(folder: Path, name: str, value) -> dict:
+    if sparse.issparse(value):
+        value = sparse.csr_matrix(value)
+        (folder / name).mkdir()
+        for part in ("data", "indices", "indptr"):
+            np.save(folder / name / f"{part}.npy", getattr(value, part))
+        return {"type": "sparse", "shape": list(value.shape), "dtype": str(value.dtype)}
+    if isinstance(value, np.ndarray):
+        # ndarray subclasses (e.g. an openTSNE embedding) are stored as plain arrays
+        value = np.asarray(value)
+        np.save(folder / f"{name}.npy", value)
+        return {"type": "dense", "shape": list(value.shape), "dtype": str(value.dtype)}
+    with open(folder / f"{name}.pkl", "wb") as f:
+        pickle.dump(value, f, protocol=pickle.HIGHEST_PROTOCOL)
+    return {"type": "pickle", "class": f"{type(value).__module__}.{type(value).__qualname__}"}
+
+
+def save_artifacts(folder: Path, keys: ty.Sequence[str], version: str = "", overwrite: bool = False,
+                   row_components: ty.Sequence[str] = ROW_COMPONENTS, **components) -> "ArtifactStore":
+    """
+    Write `keys` and `components` (name=value) to an artifact folder, see the module docstring.
+    The folder is written next to its final location and moved into place at the end,
+    so an interrupted save never leaves a partial store behind.
+
+    Parameters
+    ----------
+    version
+        free-form label stored in the manifest, e.g. the model settings
+    row_components
+        names of components that must have one row per key, checked here and by `ArtifactStore.check`
+    """
+    folder = Path(folder)
+    if folder.exists() and not overwrite:
+        raise FileExistsError(f"{folder} exists, use overwrite=True to replace it")
+    keys = np.asarray(keys, dtype=str)
+    for name in row_components:
+        if name in components and components[name].shape[0] != keys.shape[0]:
+            raise ValueError(f"{name} has {components[name].shape[0]} rows for {keys.shape[0]} keys")
+    temporary_folder = folder.with_name(f"{folder.name}.tmp")
+    if temporary_folder.exists():
+        shutil.rmtree(temporary_folder)
+    temporary_folder.mkdir(parents=True)
+    manifest = {"format_version": FORMAT_VERSION,
+                "version": version,
+                "created": time.strftime("%Y-%m-%dT%H:%M:%S"),
+                "num_keys": int(keys.shape[0]),
+                "row_components": [name for name in row_components if name in components],
+                "components": {"keys": _save_component(temporary_folder, "keys", keys)}}
+    for name, value in components.items():
+        manifest["components"][name] = _save_component(temporary_folder, name, value)
+    with open(temporary_folder / MANIFEST_FILE, "w") as f:
+        json.dump(manifest, f, indent=1)
+    if folder.exists():
+        shutil.rmtree(folder)
+    os.replace(temporary_folder, folder)
+    return ArtifactStore(folder)
+
+
+class ArtifactStore:
+    """
+    Read access to an artifact folder written by `save_artifacts`.
+    Components are attributes (store.w_matrix) or items (store["w_matrix"]), loaded on first access and cached.
+    """
+
+    def __init__(self, folder: Path, mmap_mode: ty.Union[str, None] = "r"):
+        self.folder = Path(folder)
+        self.mmap_mode = mmap_mode
+        with open(self.folder / MANIFEST_FILE) as f:
+            self.manifest = json.load(f)
+        if self.manifest["format_version"] > FORMAT_VERSION:
+            raise ValueError(f"{self.folder} has format version {self.manifest['format_version']}, "
+                             f"this code reads up to {FORMAT_VERSION}")
+        self._cache = {}
+
+    def __getstate__(self):
+        # loaded components are not sent along, e.g. to worker processes, they are loaded again there
+        return {"folder": self.folder, "mmap_mode": self.mmap_mode, "manifest": self.manifest, "_cache": {}}
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+
+    @property
+    def names(self) -> ty.List[str]:
+        return list(self.manifest["components"])
+
+    def __contains__(self, name: str) -> bool:
+        return name in self.manifest["components"]
+
+    def __getitem__(self, name: str):
+        if name not in self._cache:
+            if name not in self:
+                raise KeyError(f"{name} not in {self.folder}, components: {', '.join(self.names)}")
+            self._cache[name] = self._load(name, self.manifest["components"][name])
+        return self._cache[name]
+
+    def __getattr__(self, name: str):
+        if name.startswith("_") or name in ("folder", "mmap_mode", "manifest"):
+            raise AttributeError(name)
+        try:
+            return self[name]
+        except KeyError as e:
+            raise AttributeError(str(e)) from None
+
+    def _load(self, name: str, entry: dict):
+        if entry["type"] == "dense":
+            return np.load(self.folder / f"{name}.npy", mmap_mode=self.mmap_mode)
+        if entry["type"] == "sparse":
+            # int32 indices stay memory-mapped, scipy copies int64 ones that fit in int32
+            parts = [np.load(self.folder / name / f"{part}.npy", mmap_mode=self.mmap_mode)
+                     for part in ("data", "indices", "indptr")]
+            return sparse.csr_matrix(tuple(parts), shape=tuple(entry["shape"]), copy=False)
+        with open(self.folder / f"{name}.pkl", "rb") as f:
+            return pickle.load(f)
+
+    def check(self, check_models: bool = False):
+        """
+        Check that stored shapes agree with each other and with the manifest, without reading array data:
+        row components have one row per key, the TF-IDF matrix, vectorizer vocabulary and topic model
+        have the same number of features, and W matrices have one column per topic.
+        Models are only unpickled if `check_models` is set.
+        Raises a ValueError listing all problems.
+        """
+        problems = []
+        shapes = {}
+        for name, entry in self.manifest["components"].items():
+            if entry["type"] == "pickle":
+                continue
+            shape = tuple(self[name].shape)
+            if shape != tuple(entry["shape"]):
+                problems.append(f"{name}: shape {shape}, manifest says {tuple(entry['shape'])}")
+            shapes[name] = shape
+        num_keys = shapes["keys"][0]
+        for name in self.manifest["row_components"]:
+            if name in shapes and shapes[name][0] != num_keys:
+                problems.append(f"{name}: {shapes[name][0]} rows for {num_keys} keys")
+        num_topics = {shapes[name][1] for name in ("w_matrix", "w_matrix_norm") if name in shapes}
+        num_features = {shapes["tfidf_matrix"][1]} if "tfidf_matrix" in shapes else set()
+        if check_models:
+            if "vectorizer" in self:
+                num_features.add(self.vectorizer.vocabulary_.shape[0])
+            if "topic_model" in self:
+                num_topics.add(self.topic_model.components_.shape[0])
+                num_features.add(self.topic_model.components_.shape[1])
+            if "scaler" in self:
+                num_topics.add(self.scaler.n_features_in_)
+        if len(num_topics) > 1:
+            problems.append(f"inconsistent numbers of topics: {sorted(num_topics)}")
+        if len(num_features) > 1:
+            problems.append(f"inconsistent numbers of features: {sorted(num_features)}")
+        if problems:
+            raise ValueError(f"{self.folder}: " + "; ".join(problems))
+
+
+def load_artifacts(folder: Path, mmap_mode: ty.Union[str, None] = "r", check: bool = True) -> ArtifactStore:
+    """
+    Open an artifact folder, checking array shapes (see `ArtifactStore.check`) unless `check` is False.
+    """
+    store = ArtifactStore(folder, mmap_mode)
+    if check:
+        store.check()
+    return store
+
+
+def convert_pickle(pickle_file: Path, folder: Path, version: str = "") -> ArtifactStore:
+    """
+    Convert a topic_modelling_data.pkl file (the tuple written by the topic modelling notebook) to an artifact folder.
+    """
+    with open(pickle_file, "rb") as f:
+        (keys,
+         vectorizer, tfidf_matrix,
+         topic_model, w_matrix,
+         scaler, w_matrix_norm,
+         tsne_reducer, reduced) = pickle.load(f)
+    return save_artifacts(folder, keys, version=version,
+                          vectorizer=vectorizer, tfidf_matrix=tfidf_matrix,
+                          topic_model=topic_model, w_matrix=w_matrix,
+                          scaler=scaler, w_matrix_norm=w_matrix_norm,
+                          tsne_reducer=tsne_reducer, reduced=reduced)
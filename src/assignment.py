@@ -0,0 +1,158 @@
+"""
+Protein <-> topic assignments.
+
+A protein is assigned to a topic if its W matrix score is above the knee (kneed.KneeLocator, convex, decreasing)
+of the topic's sorted scores. All knees are found at once with array operations instead of one KneeLocator per topic.
+
+An assignment index is a folder of .npy files with a two-way CSR layout:
+topic_offsets (n_topics + 1) into topic_proteins / topic_scores, sorted by decreasing score,
+and protein_offsets (n_proteins + 1) into protein_topics / protein_scores, sorted by decreasing score.
+"""
+
+import typing as ty
+from dataclasses import dataclass
+from pathlib import Path
+
+import numpy as np
+from scipy import interpolate
+from tqdm import tqdm
+
+
+def get_knees(sorted_scores: np.ndarray, S: float = 2) -> np.ndarray:
+    """
+    Knee of each column of `sorted_scores` (n_proteins, n_topics), each sorted in decreasing order,
+    as found by KneeLocator(np.arange(n_proteins), column, S=S, curve="convex", direction="decreasing").knee
+
+    Returns
+    -------
+    (n_topics,) knee indices, -1 where no knee is found
+    """
+    num_points = sorted_scores.shape[0]
+    x = np.arange(num_points)
+    # Same steps and floating point operations as KneeLocator, vectorized over columns
+    smoothed = interpolate.interp1d(x, sorted_scores, axis=0)(x)
+    x_normalized = (x - x.min()) / (x.max() - x.min())
+    minimum, maximum = smoothed.min(axis=0), smoothed.max(axis=0)
+    with np.errstate(invalid="ignore", divide="ignore"):
+        y_normalized = (smoothed - minimum) / (maximum - minimum)
+    y_normalized = y_normalized.max(axis=0) - y_normalized
+    y_difference = y_normalized - x_normalized[:, None]
+
+    # local maxima and minima as in argrelextrema(y_difference, np.greater_equal / np.less_equal)
+    plus = np.concatenate([y_difference[1:], y_difference[-1:]])
+    minus = np.concatenate([y_difference[:1], y_difference[:-1]])
+    is_maximum = (y_difference >= plus) & (y_difference >= minus)
+    is_minimum = (y_difference <= plus) & (y_difference <= minus)
+
+    # find_knee walks the curve from the first maximum: detection is active after a maximum (threshold = its
+    # difference - S * mean step) until the next minimum, and the knee is the last maximum before the first point
+    # where the next difference drops below the threshold.
+    indices = np.arange(num_points)[:, None]
+    last_maximum = np.maximum.accumulate(np.where(is_maximum, indices, -1), axis=0)
+    last_minimum = np.maximum.accumulate(np.where(is_minimum, indices, -1), axis=0)
+    step = S * np.abs(np.diff(x_normalized).mean())
+    thresholds = np.take_along_axis(y_difference, np.maximum(last_maximum, 0), axis=0) - step
+    is_knee = (last_maximum[:-1] > last_minimum[:-1]) & (y_difference[1:] < thresholds[:-1])
+    first = np.argmax(is_knee, axis=0)
+    columns = np.arange(sorted_scores.shape[1])
+    return np.where(is_knee[first, columns], last_maximum[first, columns], -1)
+
+
+@dataclass
+class AssignmentIndex:
+    keys: np.ndarray
+    topic_offsets: np.ndarray
+    """topic i has proteins topic_proteins[topic_offsets[i]: topic_offsets[i + 1]]"""
+    topic_proteins: np.ndarray
+    topic_scores: np.ndarray
+    protein_offsets: np.ndarray
+    """protein i has topics protein_topics[protein_offsets[i]: protein_offsets[i + 1]]"""
+    protein_topics: np.ndarray
+    protein_scores: np.ndarray
+    topic_af_counts: np.ndarray
+    """number of AlphaFold ("AF-") proteins assigned to each topic"""
+    _key_to_index: ty.Union[ty.Dict[str, int], None] = None
+
+    @property
+    def num_topics(self) -> int:
+        return self.topic_offsets.shape[0] - 1
+
+    def get_topic_proteins(self, topic_id: int) -> ty.Tuple[np.ndarray, np.ndarray]:
+        """
+        Keys and scores of the proteins assigned to a topic, by decreasing score
+        """
+        start, stop = self.topic_offsets[topic_id], self.topic_offsets[topic_id + 1]
+        return self.keys[self.topic_proteins[start: stop]], self.topic_scores[start: stop]
+
+    def get_protein_index(self, key: str) -> int:
+        if self._key_to_index is None:
+            self._key_to_index = {str(k): i for i, k in enumerate(self.keys)}
+        return self._key_to_index[key]
+
+    def get_protein_topics(self, key: str) -> ty.Tuple[np.ndarray, np.ndarray]:
+        """
+        Topics a protein is assigned to and its scores in them, by decreasing score
+        """
+        index = self.get_protein_index(key)
+        start, stop = self.protein_offsets[index], self.protein_offsets[index + 1]
+        return self.protein_topics[start: stop], self.protein_scores[start: stop]
+
+    def get_split_counts(self) -> ty.Tuple[np.ndarray, np.ndarray, np.ndarray]:
+        """
+        Number of assigned proteins, AlphaFold proteins and PDB proteins of each topic
+        """
+        totals = np.diff(self.topic_offsets)
+        return totals, self.topic_af_counts, totals - self.topic_af_counts
+
+
+NAMES = ("keys", "topic_offsets", "topic_proteins", "topic_scores",
+         "protein_offsets", "protein_topics", "protein_scores", "topic_af_counts")
+
+
+def build_assignment_index(w_matrix: np.ndarray, keys: ty.Sequence[str], output_folder: Path,
+                           S: float = 2, block_size: int = 16) -> AssignmentIndex:
+    """
+    Assign proteins (rows of w_matrix) to topics (columns) by knee cutoffs and write the index to `output_folder`.
+
+    Matches the previous per-topic procedure: proteins in np.argsort(scores)[::-1] order up to the knee
+    (all proteins if there is none), and no proteins if the scores up to the cutoff sum to zero.
+    Columns are processed `block_size` at a time.
+    """
+    output_folder = Path(output_folder)
+    if not output_folder.exists():
+        output_folder.mkdir(parents=True)
+    keys = np.asarray(keys, dtype=str)
+    num_proteins, num_topics = w_matrix.shape
+    proteins, scores, lengths = [], [], np.zeros(num_topics, dtype=np.int64)
+    for start in tqdm(range(0, num_topics, block_size)):
+        block = np.asarray(w_matrix[:, start: start + block_size])
+        order = np.argsort(block, axis=0)[::-1]
+        sorted_scores = np.take_along_axis(block, order, axis=0)
+        knees = get_knees(sorted_scores, S)
+        for i, knee in enumerate(knees):
+            cutoff = num_proteins if knee == -1 else knee
+            if sorted_scores[:cutoff, i].sum() == 0:
+                cutoff = 0
+            proteins.append(order[:cutoff, i])
+            scores.append(sorted_scores[:cutoff, i])
+            lengths[start + i] = cutoff
+    topic_offsets = np.concatenate([[0], np.cumsum(lengths)])
+    topic_proteins = np.concatenate([np.zeros(0, dtype=np.int64)] + proteins)
+    topic_scores = np.concatenate([np.zeros(0, dtype=w_matrix.dtype)] + scores)
+    topic_ids = np.repeat(np.arange(num_topics), lengths)
+
+    # per protein: decreasing score, ties in topic order
+    protein_order = np.lexsort((topic_ids, -topic_scores, topic_proteins))
+    protein_offsets = np.concatenate([[0], np.cumsum(np.bincount(topic_proteins, minlength=num_proteins))])
+    is_af = np.char.startswith(keys, "AF-")
+    topic_af_counts = np.bincount(topic_ids, weights=is_af[topic_proteins], minlength=num_topics).astype(np.int64)
+    arrays = (keys, topic_offsets, topic_proteins, topic_scores,
+              protein_offsets, topic_ids[protein_order], topic_scores[protein_order], topic_af_counts)
+    for name, array in zip(NAMES, arrays):
+        np.save(output_folder / f"{name}.npy", array)
+    return load_assignment_index(output_folder)
+
+
+def load_assignment_index(folder: Path, mmap_mode: ty.Union[str, None] = "r") -> AssignmentIndex:
+    folder = Path(folder)
+    return AssignmentIndex(*(np.load(folder / f"{name}.npy", mmap_mode=mmap_mode) for name in NAMES))
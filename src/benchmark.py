@@ -0,0 +1,369 @@
+"""
+Offline benchmarks of the pipeline stages on synthetic data.
+
+Generates AlphaFold-style models (.pdb.gz with pLDDT B-factors, in proteome folders or UP0*.tar archives)
+and ProteinNet records of configurable sizes, times each stage and records its peak traced memory,
+and writes the results with throughput in structures/s and residues/s to a JSON baseline
+that later runs can be compared against:
+
+    python -m src.benchmark benchmarks/baseline.json
+    python -m src.benchmark benchmarks/new.json --compare benchmarks/baseline.json
+"""
+
+import argparse
+import gzip
+import json
+import platform
+import shutil
+import tarfile
+import tempfile
+import time
+import tracemalloc
+import typing as ty
+from contextlib import nullcontext
+from dataclasses import dataclass, asdict, field
+from pathlib import Path
+
+import numpy as np
+from scipy import ndimage
+from sklearn.decomposition import NMF
+
+from src import make_data, proteinnet_parser, corpus, plotting
+from src.pdb_parser import THREE_TO_ONE
+
+AMINO_ACIDS = sorted(THREE_TO_ONE)
+
+
+def make_trace(length: int, rng: np.random.Generator) -> np.ndarray:
+    """
+    (length, 3) alpha carbon trace of helices and strands joined by loops,
+    each element turned towards the centre of the trace so far to keep it compact.
+    """
+    coords = [np.zeros(3)]
+    while len(coords) < length:
+        kind = rng.choice(["helix", "strand", "loop"], p=[0.5, 0.3, 0.2])
+        size = int(rng.integers(4, 20))
+        t = np.arange(1, size + 1)
+        if kind == "helix":
+            local = np.stack([2.3 * np.cos(np.radians(100) * t), 2.3 * np.sin(np.radians(100) * t), 1.5 * t], 1)
+            local -= [2.3, 0, 0]
+        elif kind == "strand":
+            local = np.stack([0.9 * (t % 2), np.zeros(size), 3.3 * t], 1)
+        else:
+            steps = rng.normal(size=(size, 3))
+            local = np.cumsum(3.8 * steps / np.linalg.norm(steps, axis=1, keepdims=True), axis=0)
+        rotation, _ = np.linalg.qr(rng.normal(size=(3, 3)))
+        segment = local @ rotation.T
+        # point the segment towards the centre of what has been built so far
+        direction = np.mean(coords, axis=0) - coords[-1]
+        if np.dot(segment[-1], direction) < 0:
+            segment = -segment
+        coords.extend(coords[-1] + segment)
+    return np.array(coords[:length])
+
+
+def make_plddt(length: int, rng: np.random.Generator) -> np.ndarray:
+    """
+    Smooth per-residue confidence in [20, 98] with low confidence termini and a few low confidence stretches
+    """
+    noise = ndimage.gaussian_filter1d(rng.normal(size=length), sigma=8)
+    plddt = 85 + 12 * noise / (np.abs(noise).max() + 1e-9)
+    for _ in range(int(rng.integers(0, 3))):
+        start = int(rng.integers(0, length))
+        plddt[start: start + int(rng.integers(10, 40))] -= 45
+    termini = int(rng.integers(0, 20))
+    plddt[:termini] -= 40
+    plddt[length - termini:] -= 40
+    return np.clip(plddt, 20, 98)
+
+
+def get_model_text(coords: np.ndarray, plddt: np.ndarray, residues: ty.Sequence[str]) -> str:
+    """
+    AlphaFold-style PDB file contents: N, CA, C and O ATOM records per residue with pLDDT B-factors
+    """
+    lines = []
+    atom_number = 1
+    for i, (position, beta, residue) in enumerate(zip(coords, plddt, residues)):
+        for atom, offset in ((" N  ", -1.2), (" CA ", 0.), (" C  ", 1.2), (" O  ", 1.9)):
+            x, y, z = position + offset * np.array([0.6, 0.3, 0.2])
+            lines.append(f"ATOM  {atom_number:5d} {atom} {residue} A{i + 1:4d}    {x:8.3f}{y:8.3f}{z:8.3f}"
+                         f"  1.00{beta:6.2f}           {atom.strip()[0]}  ")
+            atom_number += 1
+    lines.append("END")
+    return "\n".join(lines) + "\n"
+
+
+def make_proteomes(root_folder: Path, num_proteomes: int = 2, num_models: int = 50,
+                   min_length: int = 80, max_length: int = 600, as_archives: bool = False,
+                   seed: int = 42) -> ty.Tuple[int, int]:
+    """
+    Write `num_proteomes` synthetic proteomes of `num_models` AlphaFold-style models each to `root_folder`,
+    as UP0* folders of AF-*-F1-model_v1.pdb.gz files, or UP0*.tar archives of them if `as_archives` is set.
+
+    Returns
+    -------
+    number of models and number of residues written
+    """
+    root_folder = Path(root_folder)
+    root_folder.mkdir(parents=True, exist_ok=True)
+    rng = np.random.default_rng(seed)
+    num_residues = 0
+    for p in range(num_proteomes):
+        name = f"UP{p:09d}_{9606 + p}"
+        folder = root_folder / name
+        folder.mkdir(exist_ok=True)
+        for m in range(num_models):
+            length = int(rng.integers(min_length, max_length + 1))
+            residues = [AMINO_ACIDS[i] for i in rng.integers(0, len(AMINO_ACIDS), length)]
+            text = get_model_text(make_trace(length, rng), make_plddt(length, rng), residues)
+            with open(folder / f"AF-X{p:02d}{m:05d}-F1-model_v1.pdb.gz", "wb") as f:
+                f.write(gzip.compress(text.encode(), mtime=0))
+            num_residues += length
+        if as_archives:
+            with tarfile.open(root_folder / f"{name}.tar", "w") as tar:
+                for filename in sorted(folder.iterdir()):
+                    tar.add(filename, arcname=filename.name)
+            shutil.rmtree(folder)
+    return num_proteomes * num_models, num_residues
+
+
+def make_proteinnet_file(filename: Path, num_records: int = 200, min_length: int = 50, max_length: int = 500,
+                         num_evo_entries: int = 20, seed: int = 42) -> ty.Tuple[int, int]:
+    """
+    Write `num_records` synthetic ProteinNet records (all sections, N/CA/C coordinates in picometres,
+    about 5% of residues masked) to `filename`.
+
+    Returns
+    -------
+    number of records and number of unmasked residues written
+    """
+    rng = np.random.default_rng(seed)
+    letters = np.array(list(proteinnet_parser._aa_dict))
+    dssp = np.array(list(proteinnet_parser._dssp_dict))
+    num_residues = 0
+    with open(filename, "w") as f:
+        for r in range(num_records):
+            length = int(rng.integers(min_length, max_length + 1))
+            mask = rng.random(length) > 0.05
+            ca = make_trace(length, rng)
+            # N and C atoms near each alpha carbon
+            atoms = np.repeat(ca, 3, axis=0) + np.tile([[-1.2, 0, 0], [0, 0, 0], [1.2, 0, 0]], (length, 1))
+            atoms[np.repeat(~mask, 3)] = 0
+            f.write(f"[ID]\n{r:04d}_1_A\n")
+            f.write("[PRIMARY]\n" + "".join(rng.choice(letters, length)) + "\n")
+            f.write("[EVOLUTIONARY]\n")
+            for _ in range(num_evo_entries):
+                f.write("\t".join(f"{x:.4f}" for x in rng.random(length)) + "\n")
+            f.write("[SECONDARY]\n" + "".join(rng.choice(dssp, length)) + "\n")
+            f.write("[TERTIARY]\n")
+            for axis in range(3):
+                f.write("\t".join(f"{x:.1f}" for x in atoms[:, axis] * 100) + "\n")
+            f.write("[MASK]\n" + "".join(np.where(mask, "+", "-")) + "\n\n")
+            num_residues += int(mask.sum())
+    return num_records, num_residues
+
+
+@dataclass
+class BenchmarkResult:
+    name: str
+    seconds: float
+    """best of the timed repeats"""
+    peak_memory_mb: float
+    """peak memory traced by tracemalloc (Python and numpy allocations of this process) in a separate run"""
+    num_structures: int
+    num_residues: int
+    parameters: ty.Dict[str, ty.Any] = field(default_factory=dict)
+
+    @property
+    def structures_per_second(self) -> float:
+        return self.num_structures / self.seconds if self.seconds > 0 else 0.
+
+    @property
+    def residues_per_second(self) -> float:
+        return self.num_residues / self.seconds if self.seconds > 0 else 0.
+
+    def to_dict(self) -> dict:
+        return dict(asdict(self), structures_per_second=self.structures_per_second,
+                    residues_per_second=self.residues_per_second)
+
+
+def measure(name: str, function: ty.Callable[[], ty.Any], num_structures: int, num_residues: int,
+            repeat: int = 3, setup: ty.Callable[[], ty.Any] = None, memory: bool = True,
+            **parameters) -> BenchmarkResult:
+    """
+    Time `function` `repeat` times (calling `setup` before each run, untimed) and keep the fastest run,
+    then run it once more under tracemalloc for its peak memory unless `memory` is False.
+    """
+    times = []
+    for _ in range(repeat):
+        if setup is not None:
+            setup()
+        start = time.perf_counter()
+        function()
+        times.append(time.perf_counter() - start)
+    peak = 0.
+    if memory:
+        if setup is not None:
+            setup()
+        tracemalloc.start()
+        function()
+        peak = tracemalloc.get_traced_memory()[1] / 1e6
+        tracemalloc.stop()
+    result = BenchmarkResult(name, min(times), peak, num_structures, num_residues, parameters)
+    print(f"{name}: {result.seconds:.3f}s, {result.peak_memory_mb:.1f} MB, "
+          f"{result.structures_per_second:.1f} structures/s, {result.residues_per_second:.0f} residues/s")
+    return result
+
+
+def _remove_outputs(root_folder: Path, patterns: ty.Sequence[str]):
+    for pattern in patterns:
+        for path in Path(root_folder).glob(pattern):
+            shutil.rmtree(path) if path.is_dir() else path.unlink()
+
+
+def run_benchmarks(work_folder: Path, num_proteomes: int = 2, num_models: int = 50, num_records: int = 200,
+                   min_length: int = 80, max_length: int = 600, num_topics: int = 20, repeat: int = 3,
+                   seed: int = 42) -> ty.List[BenchmarkResult]:
+    """
+    Generate synthetic data in `work_folder` and benchmark, single-process:
+    shapemers of AlphaFold models from folders and from archives (`make_data.get_AF_shapemers`),
+    ProteinNet parsing (`proteinnet_parser.yield_records_from_file` + `clean_entry`),
+    ProteinNet shapemers (`make_data.get_PDB_shapemers`),
+    the TF-IDF + NMF fit on the AlphaFold corpus and residue topic scores (`plotting.get_coords_topic_scores`).
+    """
+    work_folder = Path(work_folder)
+    folder_root, archive_root = work_folder / "folders", work_folder / "archives"
+    proteinnet_file = work_folder / "proteinnet" / "training"
+    for folder in (folder_root, archive_root, proteinnet_file.parent):
+        if folder.exists():
+            shutil.rmtree(folder)
+    proteinnet_file.parent.mkdir(parents=True)
+    sizes = dict(num_proteomes=num_proteomes, num_models=num_models, min_length=min_length,
+                 max_length=max_length, seed=seed)
+    num_models_total, num_af_residues = make_proteomes(folder_root, **sizes)
+    make_proteomes(archive_root, as_archives=True, **sizes)
+    num_records, num_pdb_residues = make_proteinnet_file(proteinnet_file, num_records, min_length, max_length,
+                                                         seed=seed)
+    af_outputs = ["AF_corpus_*"]
+    results = [
+        measure("get_AF_shapemers", lambda: make_data.get_AF_shapemers(folder_root),
+                num_models_total, num_af_residues, repeat,
+                setup=lambda: _remove_outputs(folder_root, af_outputs), **sizes),
+        measure("get_AF_shapemers_from_archives", lambda: make_data.get_AF_shapemers(archive_root, from_archives=True),
+                num_models_total, num_af_residues, repeat,
+                setup=lambda: _remove_outputs(archive_root, af_outputs + ["*.index"]), **sizes),
+        measure("yield_records_from_file+clean_entry",
+                lambda: [proteinnet_parser.clean_entry(entry, "ca") for entry in
+                         proteinnet_parser.yield_records_from_file(proteinnet_file, 20, make_data.PROTEINNET_FIELDS)],
+                num_records, num_pdb_residues, repeat, num_records=num_records),
+        measure("get_PDB_shapemers", lambda: make_data.get_PDB_shapemers(proteinnet_file, work_folder / "proteinnet",
+                                                                         save_moments=False),
+                num_records, num_pdb_residues, repeat,
+                setup=lambda: _remove_outputs(work_folder / "proteinnet", ["PDB_*"]), num_records=num_records),
+    ]
+
+    _remove_outputs(folder_root, af_outputs)
+    make_data.get_AF_shapemers(folder_root)
+    corpora = [corpus.load_binary_corpus(folder) for folder in sorted(folder_root.glob("AF_corpus_resolution_*"))
+               if folder.is_dir()]
+    num_documents = sum(len(c) for c in corpora)
+
+    def fit_topic_model():
+        vectorizer = corpus.ShapemerVectorizer(min_df=2)
+        tfidf_matrix = vectorizer.fit_transform(corpora)
+        topic_model = NMF(n_components=num_topics, random_state=seed, solver="cd", tol=0.0005, max_iter=500,
+                          alpha_W=.1, l1_ratio=.5)
+        topic_model.fit_transform(tfidf_matrix)
+        return vectorizer, topic_model
+
+    results.append(measure("tfidf+nmf_fit", fit_topic_model, num_documents, num_af_residues, repeat,
+                           num_topics=num_topics))
+
+    vectorizer, topic_model = fit_topic_model()
+    h_matrix_norm = topic_model.components_ / np.maximum(topic_model.components_.max(axis=1, keepdims=True), 1e-12)
+    lookup = plotting.TopicLookup.from_vocabulary(h_matrix_norm, vectorizer.vocabulary_)
+    traces = [make_trace(int(length), np.random.default_rng(seed + i)) for i, length in
+              enumerate(np.random.default_rng(seed).integers(min_length, max_length + 1, num_models))]
+    results.append(measure("get_coords_topic_scores",
+                           lambda: [plotting.get_coords_topic_scores(coords, None, None, None, lookup)
+                                    for coords in traces],
+                           len(traces), sum(len(coords) for coords in traces), repeat, num_topics=num_topics))
+    return results
+
+
+def get_environment() -> ty.Dict[str, str]:
+    import scipy
+    import sklearn
+    return {"python": platform.python_version(), "platform": platform.platform(), "processor": platform.processor(),
+            "numpy": np.__version__, "scipy": scipy.__version__, "scikit-learn": sklearn.__version__}
+
+
+def save_baseline(results: ty.Sequence[BenchmarkResult], output_file: Path, **config):
+    output_file = Path(output_file)
+    output_file.parent.mkdir(parents=True, exist_ok=True)
+    with open(output_file, "w") as f:
+        json.dump({"created": time.strftime("%Y-%m-%dT%H:%M:%S"), "environment": get_environment(), "config": config,
+                   "results": [result.to_dict() for result in results]}, f, indent=1)
+
+
+def load_baseline(baseline_file: Path) -> ty.Dict[str, dict]:
+    """
+    Benchmark name to its result in a baseline file
+    """
+    with open(baseline_file) as f:
+        return {result["name"]: result for result in json.load(f)["results"]}
+
+
+def compare_baselines(baseline_file: Path, results: ty.Sequence[BenchmarkResult],
+                      tolerance: float = 0.1) -> ty.List[str]:
+    """
+    Print the change in time and peak memory of each benchmark relative to `baseline_file`.
+
+    Returns
+    -------
+    descriptions of the benchmarks that got more than `tolerance` (relative) slower or larger
+    """
+    baseline = load_baseline(baseline_file)
+    regressions = []
+    for result in results:
+        if result.name not in baseline:
+            continue
+        old = baseline[result.name]
+        time_ratio = result.seconds / old["seconds"] if old["seconds"] > 0 else 1.
+        memory_ratio = result.peak_memory_mb / old["peak_memory_mb"] if old["peak_memory_mb"] > 0 else 1.
+        print(f"{result.name}: time x{time_ratio:.2f}, memory x{memory_ratio:.2f}")
+        if time_ratio > 1 + tolerance:
+            regressions.append(f"{result.name}: {old['seconds']:.3f}s -> {result.seconds:.3f}s")
+        if memory_ratio > 1 + tolerance:
+            regressions.append(f"{result.name}: {old['peak_memory_mb']:.1f} MB -> {result.peak_memory_mb:.1f} MB")
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("output_file", type=Path, help="JSON file to write the results to")
+    parser.add_argument("--compare", type=Path, help="baseline JSON file to compare against")
+    parser.add_argument("--tolerance", type=float, default=0.1, help="allowed relative slowdown or memory increase")
+    parser.add_argument("--work-folder", type=Path, help="folder for the synthetic data, a temporary folder by default")
+    parser.add_argument("--num-proteomes", type=int, default=2)
+    parser.add_argument("--num-models", type=int, default=50, help="models per proteome")
+    parser.add_argument("--num-records", type=int, default=200, help="ProteinNet records")
+    parser.add_argument("--min-length", type=int, default=80)
+    parser.add_argument("--max-length", type=int, default=600)
+    parser.add_argument("--num-topics", type=int, default=20)
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--seed", type=int, default=42)
+    arguments = vars(parser.parse_args())
+    output_file, baseline_file, tolerance = (arguments.pop(name) for name in ("output_file", "compare", "tolerance"))
+    work_folder = arguments.pop("work_folder")
+    with tempfile.TemporaryDirectory() if work_folder is None else nullcontext(work_folder) as folder:
+        results = run_benchmarks(Path(folder), **arguments)
+    save_baseline(results, output_file, **arguments)
+    if baseline_file is not None:
+        regressions = compare_baselines(baseline_file, results, tolerance)
+        if regressions:
+            raise SystemExit("regressions:\n" + "\n".join(regressions))
+
+
+if __name__ == "__main__":
+    main()
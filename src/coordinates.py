@@ -0,0 +1,125 @@
+"""
+Store of alpha carbon traces, so coordinates are read once and shared (memory-mapped) by every later step.
+
+A coordinate store is a folder of .npy files in a ragged layout:
+ids (one per protein), offsets (n_proteins + 1) into an (n_residues, 3) float32 coordinate array,
+and optionally per-residue float32 pLDDT (or B-factor) values and one-letter sequences (uint8),
+aligned with the coordinates.
+
+Coordinates are stored as float32, so shapemers recomputed from the store can, like those of a moment store,
+differ from ones computed from the original files when a moment lies within rounding of a bin edge.
+"""
+
+import typing as ty
+from dataclasses import dataclass
+from pathlib import Path
+
+import numpy as np
+
+from src.pdb_parser import CAStructure
+from src.sharding import Shard, read_shard_lines, read_shard_offsets, save_shard_array
+
+STREAMS = ["coordinate_ids", "coordinates", "coordinate_lengths"]
+PLDDT_STREAMS = ["plddt"]
+SEQUENCE_STREAMS = ["sequence"]
+
+
+@dataclass
+class CoordinateStore:
+    ids: np.ndarray
+    offsets: np.ndarray
+    """protein i has residues offsets[i]: offsets[i + 1]"""
+    coordinates: np.ndarray
+    plddt: ty.Union[np.ndarray, None] = None
+    sequences: ty.Union[np.ndarray, None] = None
+    """uint8 one-letter codes of all residues"""
+    _key_to_index: ty.Union[ty.Dict[str, int], None] = None
+
+    def __len__(self):
+        return self.ids.shape[0]
+
+    def __contains__(self, key: str) -> bool:
+        return key in self.key_to_index
+
+    def __getitem__(self, key: ty.Union[str, int]) -> np.ndarray:
+        """
+        (n_residues, 3) coordinates of a protein, by key or index, as a view into the store
+        """
+        return self.coordinates[self.get_slice(key)]
+
+    @property
+    def key_to_index(self) -> ty.Dict[str, int]:
+        if self._key_to_index is None:
+            self._key_to_index = {str(k): i for i, k in enumerate(self.ids)}
+        return self._key_to_index
+
+    def get_slice(self, key: ty.Union[str, int]) -> slice:
+        index = self.key_to_index[key] if isinstance(key, str) else key
+        return slice(int(self.offsets[index]), int(self.offsets[index + 1]))
+
+    def get_plddt(self, key: ty.Union[str, int]) -> np.ndarray:
+        if self.plddt is None:
+            raise ValueError("store has no pLDDT values")
+        return self.plddt[self.get_slice(key)]
+
+    def get_sequence(self, key: ty.Union[str, int]) -> str:
+        if self.sequences is None:
+            raise ValueError("store has no sequences")
+        return np.asarray(self.sequences[self.get_slice(key)]).tobytes().decode()
+
+    def get_structure(self, key: ty.Union[str, int]) -> CAStructure:
+        """
+        Protein as a `pdb_parser.CAStructure`, with pLDDT values of 100 if the store has none
+        and a sequence of X if it has no sequences.
+        """
+        residues = self.get_slice(key)
+        num_residues = residues.stop - residues.start
+        return CAStructure(key if isinstance(key, str) else str(self.ids[key]),
+                           self.coordinates[residues],
+                           self.plddt[residues] if self.plddt is not None else np.full(num_residues, 100,
+                                                                                       dtype=np.float32),
+                           self.get_sequence(key) if self.sequences is not None else "X" * num_residues)
+
+
+def get_streams(plddt: bool = True, sequence: bool = True) -> ty.List[str]:
+    return STREAMS + (PLDDT_STREAMS if plddt else []) + (SEQUENCE_STREAMS if sequence else [])
+
+
+def write_coordinates(shard: Shard, key: str, coordinates: np.ndarray,
+                      plddt: ty.Union[np.ndarray, None] = None, sequence: ty.Union[str, None] = None):
+    """
+    Append one protein to the coordinate streams of a shard (see `get_streams`).
+    pLDDT values and sequence must be given if the shard has streams for them.
+    """
+    shard.write("coordinate_ids", (key + "\n").encode())
+    shard.write("coordinates", np.ascontiguousarray(coordinates, dtype=np.float32).tobytes())
+    shard.write("coordinate_lengths", np.int64(coordinates.shape[0]).tobytes())
+    if "plddt" in shard.paths:
+        shard.write("plddt", np.ascontiguousarray(plddt, dtype=np.float32).tobytes())
+    if "sequence" in shard.paths:
+        if len(sequence) != coordinates.shape[0]:
+            raise ValueError(f"{key}: sequence length {len(sequence)} for {coordinates.shape[0]} residues")
+        shard.write("sequence", sequence.encode())
+
+
+def write_coordinate_store(shards: ty.Sequence[Shard], output_folder: Path):
+    """
+    Merge the coordinate streams of `shards`, in the given order, into a coordinate store folder.
+    """
+    output_folder = Path(output_folder)
+    if not output_folder.exists():
+        output_folder.mkdir(parents=True)
+    np.save(output_folder / "ids.npy", np.array(read_shard_lines(shards, "coordinate_ids"), dtype=str))
+    np.save(output_folder / "offsets.npy", read_shard_offsets(shards, "coordinate_lengths"))
+    save_shard_array(shards, "coordinates", output_folder / "coordinates.npy", np.float32, (3,))
+    if all("plddt" in shard.paths for shard in shards):
+        save_shard_array(shards, "plddt", output_folder / "plddt.npy", np.float32)
+    if all("sequence" in shard.paths for shard in shards):
+        save_shard_array(shards, "sequence", output_folder / "sequences.npy", np.uint8)
+
+
+def load_coordinate_store(folder: Path, mmap_mode: ty.Union[str, None] = "r") -> CoordinateStore:
+    folder = Path(folder)
+    arrays = [np.load(folder / f"{name}.npy", mmap_mode=mmap_mode) if (folder / f"{name}.npy").exists() else None
+              for name in ("ids", "offsets", "coordinates", "plddt", "sequences")]
+    return CoordinateStore(*arrays)
@@ -0,0 +1,263 @@
+"""
+Integer-encoded shapemer corpora.
+
+A shapemer (four discretized moment invariants from a kmer or radius fragment) is packed into one int64 code:
+one bit for kmer (0) / radius (1), then 15 bits per moment value.
+Codes sort by fragment type first, then by moment values.
+
+A binary corpus is a folder of .npy files in CSR layout:
+ids (one per document), offsets (n_documents + 1), and the sorted unique codes of each document with their counts.
+"""
+
+import typing as ty
+from dataclasses import dataclass
+from pathlib import Path
+
+import numpy as np
+from scipy import sparse
+from sklearn.feature_extraction.text import TfidfTransformer
+from tqdm import tqdm
+
+from src.sharding import Shard, read_shard_lines, read_shard_offsets, save_shard_array, temporary_shard
+
+BITS = 15
+BIAS = 1 << (BITS - 1)
+MASK = (1 << BITS) - 1
+SHIFTS = np.array([3 * BITS, 2 * BITS, BITS, 0], dtype=np.int64)
+RADIUS_FLAG = 4 * BITS
+STREAMS = ["ids", "codes", "counts", "lengths"]
+
+
+def encode_shapemers(shapemers: np.ndarray, radius: bool = False) -> np.ndarray:
+    """
+    Pack (n, 4) discretized moment invariants into n int64 codes.
+    """
+    shapemers = np.asarray(shapemers, dtype=np.int64).reshape(-1, 4) + BIAS
+    if np.any((shapemers < 0) | (shapemers > MASK)):
+        raise ValueError(f"shapemer values must be in [{-BIAS}, {MASK - BIAS}]")
+    return np.bitwise_or.reduce(shapemers << SHIFTS, axis=1) | (np.int64(radius) << RADIUS_FLAG)
+
+
+def decode_shapemers(codes: np.ndarray) -> ty.Tuple[np.ndarray, np.ndarray]:
+    """
+    Inverse of `encode_shapemers`.
+
+    Returns
+    -------
+    (n,) boolean array, True for radius shapemers, and (n, 4) moment values
+    """
+    codes = np.asarray(codes, dtype=np.int64)
+    return (codes >> RADIUS_FLAG).astype(bool), ((codes[:, None] >> SHIFTS) & MASK) - BIAS
+
+
+def codes_to_strings(codes: np.ndarray) -> ty.List[str]:
+    """
+    Text form of shapemer codes, e.g. k3i5i2i7 / r3i5i2i7
+    """
+    radius, shapemers = decode_shapemers(codes)
+    return [f"{'r' if r else 'k'}{x[0]}i{x[1]}i{x[2]}i{x[3]}" for r, x in zip(radius, shapemers.tolist())]
+
+
+def strings_to_codes(strings: ty.Iterable[str]) -> np.ndarray:
+    """
+    Inverse of `codes_to_strings`.
+    """
+    strings = list(strings)
+    shapemers = np.array([s[1:].split("i") for s in strings], dtype=np.int64).reshape(-1, 4)
+    radius = np.array([s[0] == "r" for s in strings], dtype=bool)
+    return encode_shapemers(shapemers) | (radius.astype(np.int64) << RADIUS_FLAG)
+
+
+@dataclass
+class BinaryCorpus:
+    ids: np.ndarray
+    offsets: np.ndarray
+    """document i has codes[offsets[i]: offsets[i + 1]]"""
+    codes: np.ndarray
+    """sorted unique shapemer codes of each document"""
+    counts: np.ndarray
+    """number of occurrences of each code in its document"""
+
+    def __len__(self):
+        return self.ids.shape[0]
+
+    def __getitem__(self, index) -> ty.Tuple[np.ndarray, np.ndarray]:
+        start, stop = self.offsets[index], self.offsets[index + 1]
+        return self.codes[start: stop], self.counts[start: stop]
+
+    def get_count_matrix(self, vocabulary: np.ndarray, start: int = 0, stop: int = None) -> sparse.csr_matrix:
+        """
+        Document-term count matrix of documents start to stop (default all)
+        with one column per code in the sorted array `vocabulary`, codes not in `vocabulary` are dropped.
+        """
+        stop = len(self) if stop is None else min(stop, len(self))
+        offsets = np.asarray(self.offsets[start: stop + 1])
+        codes = np.asarray(self.codes[offsets[0]: offsets[-1]])
+        columns = np.searchsorted(vocabulary, codes)
+        found = columns < vocabulary.shape[0]
+        found[found] = vocabulary[columns[found]] == codes[found]
+        rows = np.repeat(np.arange(stop - start, dtype=np.int64), np.diff(offsets))
+        return sparse.csr_matrix((np.asarray(self.counts[offsets[0]: offsets[-1]])[found],
+                                  (rows[found], columns[found])),
+                                 shape=(stop - start, vocabulary.shape[0]), dtype=np.int64)
+
+
+def write_document(shard: Shard, key: str, codes: np.ndarray):
+    """
+    Append one document to the `STREAMS` of a shard.
+    """
+    codes, counts = np.unique(codes, return_counts=True)
+    shard.write("ids", (key + "\n").encode())
+    shard.write("codes", codes.astype(np.int64).tobytes())
+    shard.write("counts", counts.astype(np.int32).tobytes())
+    shard.write("lengths", np.int64(codes.shape[0]).tobytes())
+
+
+def write_binary_corpus(shards: ty.Sequence[Shard], output_folder: Path):
+    """
+    Merge the corpus streams of `shards`, in the given order, into a binary corpus folder.
+    """
+    output_folder = Path(output_folder)
+    if not output_folder.exists():
+        output_folder.mkdir(parents=True)
+    np.save(output_folder / "ids.npy", np.array(read_shard_lines(shards, "ids"), dtype=str))
+    np.save(output_folder / "offsets.npy", read_shard_offsets(shards, "lengths"))
+    save_shard_array(shards, "codes", output_folder / "codes.npy", np.int64)
+    save_shard_array(shards, "counts", output_folder / "counts.npy", np.int32)
+
+
+def load_binary_corpus(folder: Path, mmap_mode: ty.Union[str, None] = "r") -> BinaryCorpus:
+    folder = Path(folder)
+    return BinaryCorpus(*(np.load(folder / f"{name}.npy", mmap_mode=mmap_mode)
+                          for name in ("ids", "offsets", "codes", "counts")))
+
+
+def get_memory_corpus(keys: ty.Sequence[str], documents: ty.Sequence[np.ndarray]) -> BinaryCorpus:
+    """
+    In-memory corpus of shapemer code arrays (one per key), e.g. for a few query structures.
+    """
+    codes, counts = zip(*(np.unique(d, return_counts=True) for d in documents)) if len(documents) else ((), ())
+    lengths = [c.shape[0] for c in codes]
+    return BinaryCorpus(np.array(keys, dtype=str),
+                        np.concatenate([[0], np.cumsum(lengths, dtype=np.int64)]),
+                        np.concatenate([np.zeros(0, dtype=np.int64)] + [c.astype(np.int64) for c in codes]),
+                        np.concatenate([np.zeros(0, dtype=np.int32)] + [c.astype(np.int32) for c in counts]))
+
+
+def load_shard_corpus(shard: Shard) -> BinaryCorpus:
+    """
+    The documents of one complete shard with corpus `STREAMS` (e.g. one proteome), memory-mapped,
+    without merging it into a corpus folder first.
+    """
+    if not shard.complete:
+        raise ValueError(f"shard {shard.name} in {shard.folder} is not complete")
+    arrays = [np.memmap(shard.paths[stream], dtype=dtype, mode="r") if shard.paths[stream].stat().st_size
+              else np.zeros(0, dtype=dtype) for stream, dtype in (("codes", np.int64), ("counts", np.int32))]
+    return BinaryCorpus(np.array(read_shard_lines([shard], "ids"), dtype=str),
+                        read_shard_offsets([shard], "lengths"), *arrays)
+
+
+def get_document_frequencies(corpora: ty.Sequence[BinaryCorpus],
+                             block_size: int = 100_000) -> ty.Tuple[np.ndarray, np.ndarray]:
+    """
+    Sorted codes occurring in `corpora` and the number of documents each occurs in,
+    counted `block_size` documents at a time.
+    """
+    codes, frequencies = np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64)
+    for c in corpora:
+        for start in range(0, len(c), block_size):
+            block_codes, block_frequencies = np.unique(
+                np.asarray(c.codes[c.offsets[start]: c.offsets[min(start + block_size, len(c))]]), return_counts=True)
+            codes, inverse = np.unique(np.concatenate([codes, block_codes]), return_inverse=True)
+            frequencies = np.bincount(inverse, weights=np.concatenate([frequencies, block_frequencies]),
+                                      minlength=codes.shape[0]).astype(np.int64)
+    return codes, frequencies
+
+
+def export_text_corpus(corpus: BinaryCorpus, output_file: Path):
+    """
+    Write a binary corpus in the text format, one "key<TAB>shapemers" line per document.
+    Shapemers of a document are written in code order rather than the order they were computed in.
+    """
+    with open(output_file, "w") as f:
+        for i in tqdm(range(len(corpus))):
+            codes, counts = corpus[i]
+            f.write(corpus.ids[i] + "\t" + " ".join(np.repeat(codes_to_strings(codes), counts)) + "\n")
+
+
+def import_text_corpus(text_file: Path, output_folder: Path):
+    """
+    Convert a text corpus file into a binary corpus folder.
+    """
+    output_folder = Path(output_folder)
+    with temporary_shard(output_folder, "import", STREAMS) as shard:
+        with shard, open(text_file) as f:
+            for line in tqdm(f):
+                key, *shapemers = line.strip().split("\t")
+                write_document(shard, key, strings_to_codes(shapemers[0].split() if shapemers else []))
+        write_binary_corpus([shard], output_folder)
+
+
+class ShapemerVectorizer:
+    """
+    Counterpart of sklearn's TfidfVectorizer for binary corpora.
+
+    Builds count and TF-IDF matrices straight from the code arrays of `BinaryCorpus` objects,
+    with the same min_df filtering and (default) TfidfTransformer settings.
+    Fitting only counts document frequencies, a block of documents at a time, so it works on memory-mapped corpora
+    of any size, and `iter_transform` yields the TF-IDF matrix in row chunks.
+    Columns are ordered by code, `get_feature_names` returns the text form of each column.
+    """
+
+    def __init__(self, min_df: int = 1, **tfidf_kwargs):
+        self.min_df = min_df
+        self.tfidf_kwargs = tfidf_kwargs
+        self.vocabulary_ = None
+        self.document_frequencies_ = None
+        self.num_documents_ = None
+        self.transformer_ = None
+
+    def fit_vocabulary(self, corpora: ty.Sequence[BinaryCorpus]):
+        codes, document_frequencies = get_document_frequencies(corpora)
+        keep = document_frequencies >= self.min_df
+        self.vocabulary_ = codes[keep]
+        self.document_frequencies_ = document_frequencies[keep]
+        self.num_documents_ = sum(len(c) for c in corpora)
+        return self
+
+    def get_count_matrix(self, corpora: ty.Sequence[BinaryCorpus]) -> sparse.csr_matrix:
+        return sparse.vstack([c.get_count_matrix(self.vocabulary_) for c in corpora], format="csr")
+
+    def fit(self, corpora: ty.Sequence[BinaryCorpus]):
+        """
+        Fit the vocabulary and the IDF weights of TfidfTransformer (computed as in its fit) from document frequencies.
+        """
+        self.fit_vocabulary(corpora)
+        self.transformer_ = TfidfTransformer(**self.tfidf_kwargs)
+        if self.transformer_.use_idf:
+            smooth = int(self.transformer_.smooth_idf)
+            idf = np.full(self.vocabulary_.shape[0], self.num_documents_ + smooth, dtype=np.float64)
+            idf /= self.document_frequencies_ + smooth
+            self.transformer_.idf_ = np.log(idf) + 1.
+        self.transformer_.n_features_in_ = self.vocabulary_.shape[0]
+        return self
+
+    def fit_transform(self, corpora: ty.Sequence[BinaryCorpus]) -> sparse.csr_matrix:
+        return self.fit(corpora).transform(corpora)
+
+    def transform(self, corpora: ty.Sequence[BinaryCorpus]) -> sparse.csr_matrix:
+        return self.transformer_.transform(self.get_count_matrix(corpora))
+
+    def iter_transform(self, corpora: ty.Sequence[BinaryCorpus], chunk_size: int = 10_000) -> ty.Iterator[sparse.csr_matrix]:
+        """
+        TF-IDF matrix of `corpora` in chunks of up to `chunk_size` rows, in document order.
+        """
+        for c in corpora:
+            for start in range(0, len(c), chunk_size):
+                yield self.transformer_.transform(c.get_count_matrix(self.vocabulary_, start, start + chunk_size))
+
+    def get_feature_names(self) -> ty.List[str]:
+        return codes_to_strings(self.vocabulary_)
+
+    def get_feature_names_out(self) -> np.ndarray:
+        return np.array(self.get_feature_names(), dtype=object)
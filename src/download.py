@@ -0,0 +1,229 @@
+"""
+Parallel, resumable FTP mirroring of the AlphaFold database folder.
+
+Each worker thread keeps its own FTP connection. Partial files are resumed from their current size (REST),
+files whose size (and checksum, if the server publishes them) already match are skipped.
+"""
+
+import ftplib
+import hashlib
+import threading
+import time
+import typing as ty
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from dataclasses import dataclass
+from pathlib import Path
+
+from tqdm import tqdm
+
+FTP_HOST = "ftp.ebi.ac.uk"
+FTP_FOLDER = "/pub/databases/alphafold"
+FTP_ERRORS = (ftplib.Error, OSError, EOFError)
+
+
+@dataclass
+class DownloadResult:
+    filename: str
+    status: str
+    """skipped, downloaded or resumed"""
+    num_bytes: int
+    """bytes transferred in this run"""
+    seconds: float
+
+    @property
+    def throughput(self) -> float:
+        """MB/s"""
+        return self.num_bytes / 1e6 / self.seconds if self.seconds > 0 else 0.
+
+
+class FTPPool:
+    """
+    One logged-in FTP connection per thread, in binary mode and in `folder`, reopened after errors.
+    """
+
+    def __init__(self, host: str = FTP_HOST, port: int = 21, folder: str = FTP_FOLDER,
+                 user: str = "", password: str = "", timeout: float = 60.):
+        self.host, self.port, self.folder = host, port, folder
+        self.user, self.password, self.timeout = user, password, timeout
+        self._local = threading.local()
+        self._connections = []
+        self._lock = threading.Lock()
+
+    def connect(self) -> ftplib.FTP:
+        ftp = ftplib.FTP()
+        ftp.connect(self.host, self.port, timeout=self.timeout)
+        ftp.login(self.user, self.password)
+        ftp.cwd(self.folder)
+        ftp.voidcmd("TYPE I")
+        with self._lock:
+            self._connections.append(ftp)
+        return ftp
+
+    def get(self) -> ftplib.FTP:
+        if getattr(self._local, "ftp", None) is None:
+            self._local.ftp = self.connect()
+        return self._local.ftp
+
+    def reset(self):
+        """
+        Drop this thread's connection, the next `get` reconnects.
+        """
+        ftp = getattr(self._local, "ftp", None)
+        self._local.ftp = None
+        if ftp is not None:
+            with self._lock:
+                self._connections.remove(ftp)
+            try:
+                ftp.close()
+            except FTP_ERRORS:
+                pass
+
+    def close(self):
+        with self._lock:
+            for ftp in self._connections:
+                try:
+                    ftp.quit()
+                except FTP_ERRORS:
+                    ftp.close()
+            self._connections = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+
+def get_md5(filename: Path, block_size: int = 1 << 20) -> str:
+    md5 = hashlib.md5()
+    with open(filename, "rb") as f:
+        for block in iter(lambda: f.read(block_size), b""):
+            md5.update(block)
+    return md5.hexdigest()
+
+
+def get_local_md5(filename: Path) -> str:
+    """
+    MD5 of `filename`, cached in a "<filename>.md5" file so complete files are only hashed once.
+    """
+    filename = Path(filename)
+    md5_file = Path(f"{filename}.md5")
+    if md5_file.exists() and md5_file.stat().st_mtime >= filename.stat().st_mtime:
+        return md5_file.read_text().strip()
+    md5 = get_md5(filename)
+    md5_file.write_text(md5 + "\n")
+    return md5
+
+
+def read_checksums(text: str) -> ty.Dict[str, str]:
+    """
+    Filename to MD5 from md5sum output ("<md5>  <filename>" lines).
+    """
+    checksums = {}
+    for line in text.splitlines():
+        if line.strip():
+            md5, filename = line.split(maxsplit=1)
+            checksums[filename.lstrip("*")] = md5.lower()
+    return checksums
+
+
+def is_complete(filename: Path, size: int, md5: ty.Union[str, None] = None) -> bool:
+    filename = Path(filename)
+    if not filename.exists() or filename.stat().st_size != size:
+        return False
+    return md5 is None or get_local_md5(filename) == md5
+
+
+def download_file(pool: FTPPool, filename: str, size: int, output_folder: Path, md5: ty.Union[str, None] = None,
+                  num_tries: int = 5, backoff: float = 1., progress: ty.Union[tqdm, None] = None) -> DownloadResult:
+    """
+    Download one file of `size` bytes, resuming from the size of an existing partial file.
+    Connection errors reconnect and resume, with exponential backoff, up to `num_tries` times.
+    A file that ends up larger than `size` or with the wrong checksum is downloaded again from the start.
+    """
+    output_file = Path(output_folder) / filename
+    start_time = time.time()
+    if is_complete(output_file, size, md5):
+        return DownloadResult(filename, "skipped", 0, 0.)
+    start_size = output_file.stat().st_size if output_file.exists() else 0
+    num_bytes = 0
+    for try_number in range(num_tries):
+        offset = output_file.stat().st_size if output_file.exists() else 0
+        if offset > size or (offset == size and not is_complete(output_file, size, md5)):
+            output_file.unlink()
+            start_size = offset = 0
+        try:
+            if offset < size:
+                with open(output_file, "ab") as f:
+                    def write(block):
+                        nonlocal num_bytes
+                        f.write(block)
+                        num_bytes += len(block)
+                        if progress is not None:
+                            progress.update(len(block))
+
+                    pool.get().retrbinary(f"RETR {filename}", write, rest=offset or None)
+            if is_complete(output_file, size, md5):
+                return DownloadResult(filename, "resumed" if start_size else "downloaded",
+                                      num_bytes, time.time() - start_time)
+        except FTP_ERRORS:
+            pool.reset()
+        if try_number < num_tries - 1:
+            time.sleep(backoff * 2 ** try_number)
+    raise RuntimeError(f"{filename}: download incomplete or failed verification after {num_tries} tries")
+
+
+def download_folder(output_folder: Path, host: str = FTP_HOST, port: int = 21, folder: str = FTP_FOLDER,
+                    num_connections: int = 4, checksum_file: ty.Union[str, None] = None,
+                    filenames: ty.Union[ty.Sequence[str], None] = None,
+                    num_tries: int = 5, backoff: float = 1.) -> ty.List[DownloadResult]:
+    """
+    Mirror the files of an FTP folder into `output_folder` over `num_connections` parallel connections.
+
+    Parameters
+    ----------
+    checksum_file
+        name of an md5sum-style file in the FTP folder, if given files are verified against it
+    filenames
+        files to download, all files in the folder by default
+
+    Returns
+    -------
+    one DownloadResult per file, in name order.
+    Raises a RuntimeError after all other files are done if any file could not be downloaded.
+    """
+    output_folder = Path(output_folder)
+    if not output_folder.exists():
+        output_folder.mkdir(parents=True)
+    with FTPPool(host, port, folder) as pool:
+        ftp = pool.get()
+        if filenames is None:
+            filenames = [f for f in ftp.nlst() if f != checksum_file]
+        filenames = sorted(filenames)
+        ftp.voidcmd("TYPE I")
+        sizes = {filename: ftp.size(filename) for filename in filenames}
+        checksums = {}
+        if checksum_file is not None:
+            lines = []
+            ftp.retrlines(f"RETR {checksum_file}", lines.append)
+            checksums = read_checksums("\n".join(lines))
+        results, failures = {}, []
+        with tqdm(total=sum(sizes.values()), unit="B", unit_scale=True) as progress, \
+                ThreadPoolExecutor(num_connections) as executor:
+            futures = {executor.submit(download_file, pool, filename, sizes[filename], output_folder,
+                                       checksums.get(filename), num_tries, backoff, progress): filename
+                       for filename in filenames}
+            for future in as_completed(futures):
+                filename = futures[future]
+                try:
+                    result = future.result()
+                except RuntimeError as e:
+                    failures.append(e)
+                    continue
+                results[filename] = result
+                progress.update(sizes[filename] - result.num_bytes)
+                progress.write(f"{filename}: {result.status}, {result.num_bytes / 1e6:.1f} MB "
+                               f"in {result.seconds:.1f}s ({result.throughput:.1f} MB/s)")
+    if failures:
+        raise RuntimeError(f"{len(failures)} of {len(filenames)} downloads failed, first: {failures[0]}")
+    return [results[filename] for filename in filenames]
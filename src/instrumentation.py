@@ -0,0 +1,269 @@
+"""
+Stage timers, counters and failure quarantine for the structure processing pipeline.
+
+Processing functions mark their stages with `timer` and report what they read with `count` and `add_segments`.
+These are no-ops unless the function runs inside `run_instrumented`, which collects them into a `StructureRecord`
+(in the worker process) and turns data errors (see QUARANTINE_ERRORS) into a quarantine reason instead of aborting
+the run. Any other exception, a bug or an I/O failure that a rerun may not hit, is raised as usual.
+`Instrumentation` gathers the records of each proteome into `ProteomeMetrics`,
+appends them to a JSON lines file and malformed structures to a tab-separated quarantine file.
+Subclass it and override `on_proteome`, `on_structure` or `on_quarantine` to send them elsewhere.
+"""
+
+import gzip
+import json
+import time
+import typing as ty
+import zlib
+from contextlib import contextmanager
+from dataclasses import dataclass, field
+from pathlib import Path
+
+import numpy as np
+
+# lower edges of the segment length histogram bins, the last bin is open-ended
+SEGMENT_LENGTH_EDGES = (0, 10, 20, 50, 100, 200, 500, 1000, 2000)
+
+_CURRENT_RECORD = None
+
+
+class MalformedStructureError(ValueError):
+    """
+    Raised by processing functions for input that cannot be processed, e.g. a model without alpha carbons
+    """
+
+
+# errors of malformed input: corrupt or truncated gzip files and unparseable values.
+# Other OSErrors (e.g. a failed read on a network filesystem) are not quarantined,
+# the run stops before checkpointing past the file and a rerun resumes with it.
+QUARANTINE_ERRORS = (MalformedStructureError, gzip.BadGzipFile, EOFError, zlib.error, ValueError)
+
+
+@dataclass
+class StructureRecord:
+    name: str
+    seconds: ty.Dict[str, float] = field(default_factory=dict)
+    """time spent in each stage"""
+    bytes_read: int = 0
+    num_residues: int = 0
+    segment_lengths: ty.List[int] = field(default_factory=list)
+    """lengths of the high-confidence segments found"""
+    error: ty.Union[str, None] = None
+
+
+@contextmanager
+def timer(stage: str):
+    """
+    Add the time spent in the `with` block to `stage` of the current record, if any
+    """
+    record = _CURRENT_RECORD
+    if record is None:
+        yield
+        return
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        record.seconds[stage] = record.seconds.get(stage, 0.) + time.perf_counter() - start
+
+
+def count(bytes_read: int = 0, num_residues: int = 0):
+    if _CURRENT_RECORD is not None:
+        _CURRENT_RECORD.bytes_read += bytes_read
+        _CURRENT_RECORD.num_residues += num_residues
+
+
+def add_segments(lengths: ty.Iterable[int]):
+    if _CURRENT_RECORD is not None:
+        _CURRENT_RECORD.segment_lengths.extend(int(length) for length in lengths)
+
+
+def get_name(source) -> str:
+    """
+    Name of a processing function input for records: file or archive member name, or a ProteinNet ID
+    """
+    if isinstance(source, dict):
+        return str(source.get("ID"))
+    return str(getattr(source, "name", source))
+
+
+def run_instrumented(function: ty.Callable, source,
+                     errors: ty.Tuple[ty.Type[Exception], ...] = QUARANTINE_ERRORS
+                     ) -> ty.Tuple[ty.Any, StructureRecord]:
+    """
+    Run `function(source)` with stage timers and counters collected into a StructureRecord.
+    Picklable with functools.partial, so it can wrap the process function of a worker pool.
+
+    Returns
+    -------
+    (result, record), result is None and record.error is set if the function raised one of `errors`
+    """
+    global _CURRENT_RECORD
+    record = StructureRecord(get_name(source))
+    _CURRENT_RECORD = record
+    start = time.perf_counter()
+    try:
+        result = function(source)
+    except errors as e:
+        result = None
+        record.error = f"{type(e).__name__}: {e}"
+    finally:
+        _CURRENT_RECORD = None
+    record.seconds["total"] = time.perf_counter() - start
+    return result, record
+
+
+@dataclass
+class ProteomeMetrics:
+    proteome: str
+    num_files: int = 0
+    num_quarantined: int = 0
+    seconds: float = 0.
+    """wall time, including waiting for workers"""
+    stage_seconds: ty.Dict[str, float] = field(default_factory=dict)
+    """summed over structures, so over all workers"""
+    bytes_read: int = 0
+    num_residues: int = 0
+    segment_length_counts: np.ndarray = field(default_factory=lambda: np.zeros(len(SEGMENT_LENGTH_EDGES),
+                                                                               dtype=np.int64))
+
+    @property
+    def files_per_second(self) -> float:
+        return self.num_files / self.seconds if self.seconds > 0 else 0.
+
+    @property
+    def residues_per_second(self) -> float:
+        return self.num_residues / self.seconds if self.seconds > 0 else 0.
+
+    def add(self, record: StructureRecord):
+        self.num_files += 1
+        self.num_quarantined += record.error is not None
+        for stage, seconds in record.seconds.items():
+            self.add_time(stage, seconds)
+        self.bytes_read += record.bytes_read
+        self.num_residues += record.num_residues
+        if record.segment_lengths:
+            bins = np.searchsorted(SEGMENT_LENGTH_EDGES, record.segment_lengths, side="right") - 1
+            self.segment_length_counts += np.bincount(bins, minlength=len(SEGMENT_LENGTH_EDGES))
+
+    def add_time(self, stage: str, seconds: float):
+        self.stage_seconds[stage] = self.stage_seconds.get(stage, 0.) + seconds
+
+    def to_dict(self) -> dict:
+        return {"type": "proteome", "proteome": self.proteome, "num_files": self.num_files,
+                "num_quarantined": self.num_quarantined, "seconds": self.seconds,
+                "files_per_second": self.files_per_second, "residues_per_second": self.residues_per_second,
+                "bytes_read": self.bytes_read, "num_residues": self.num_residues,
+                "stage_seconds": self.stage_seconds,
+                "segment_length_histogram": {"edges": list(SEGMENT_LENGTH_EDGES),
+                                             "counts": self.segment_length_counts.tolist()}}
+
+
+class Instrumentation:
+    """
+    Collects `StructureRecord`s per proteome (or ProteinNet file).
+
+    Parameters
+    ----------
+    metrics_file
+        JSON lines file that one line per proteome (and per structure, if `record_structures` is set) is appended to
+    quarantine_file
+        tab-separated file that a "proteome, structure, reason" line is appended to for each failed structure,
+        failures are printed if None
+    """
+
+    def __init__(self, metrics_file: ty.Union[Path, None] = None, quarantine_file: ty.Union[Path, None] = None,
+                 record_structures: bool = False):
+        self.metrics_file = metrics_file
+        self.quarantine_file = quarantine_file
+        self.record_structures = record_structures
+        self.current = None
+        self._start_time = None
+        self.proteomes: ty.List[ProteomeMetrics] = []
+
+    def start_proteome(self, name: str):
+        self.current = ProteomeMetrics(name)
+        self._start_time = time.perf_counter()
+
+    def add(self, record: StructureRecord):
+        self.current.add(record)
+        if record.error is not None:
+            self.on_quarantine(self.current.proteome, record.name, record.error)
+        if self.record_structures:
+            self.on_structure(self.current.proteome, record)
+
+    def add_time(self, stage: str, seconds: float):
+        self.current.add_time(stage, seconds)
+
+    def add_files(self, num_files: int):
+        """
+        Count files handled together in this process, without a record each, e.g. in one batch query
+        """
+        self.current.num_files += num_files
+
+    @contextmanager
+    def timer(self, stage: str):
+        """
+        Time a stage that runs in this process, e.g. writing results
+        """
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add_time(stage, time.perf_counter() - start)
+
+    def end_proteome(self) -> ProteomeMetrics:
+        self.current.seconds = time.perf_counter() - self._start_time
+        metrics, self.current = self.current, None
+        self.proteomes.append(metrics)
+        self.on_proteome(metrics)
+        return metrics
+
+    def on_proteome(self, metrics: ProteomeMetrics):
+        print(f"{metrics.proteome}: {metrics.num_files} files in {metrics.seconds:.1f}s "
+              f"({metrics.files_per_second:.1f} files/s, {metrics.residues_per_second:.0f} residues/s), "
+              f"{metrics.num_quarantined} quarantined")
+        self._write_line(metrics.to_dict())
+
+    def on_structure(self, proteome: str, record: StructureRecord):
+        self._write_line({"type": "structure", "proteome": proteome, "name": record.name,
+                          "seconds": record.seconds, "bytes_read": record.bytes_read,
+                          "num_residues": record.num_residues, "segment_lengths": record.segment_lengths,
+                          "error": record.error})
+
+    def on_quarantine(self, proteome: str, name: str, reason: str):
+        reason = " ".join(reason.split())
+        if self.quarantine_file is None:
+            print(f"{proteome}: quarantined {name}: {reason}")
+            return
+        with open(self.quarantine_file, "a") as f:
+            f.write(f"{proteome}\t{name}\t{reason}\n")
+
+    def _write_line(self, values: dict):
+        if self.metrics_file is not None:
+            with open(self.metrics_file, "a") as f:
+                f.write(json.dumps(values) + "\n")
+
+
+def load_quarantine(quarantine_file: Path) -> ty.List[ty.Tuple[str, str, str]]:
+    """
+    (proteome, structure, reason) of each quarantined structure in a quarantine file.
+    A resumed run processes the structures after the last checkpoint again and appends them a second time,
+    so only the last line of each (proteome, structure) is kept.
+    """
+    if not Path(quarantine_file).exists():
+        return []
+    with open(quarantine_file) as f:
+        lines = [tuple(line.rstrip("\n").split("\t", 2)) for line in f if line.strip()]
+    return list({line[:2]: line for line in lines}.values())
+
+
+def load_metrics(metrics_file: Path, record_type: str = "proteome") -> ty.List[dict]:
+    """
+    Lines of one type ("proteome" or "structure") of a metrics file,
+    keeping only the last line of each proteome (or structure of a proteome), as in `load_quarantine`.
+    The line of a resumed proteome only covers the structures processed after the resume.
+    """
+    with open(metrics_file) as f:
+        lines = [values for values in map(json.loads, f) if values["type"] == record_type]
+    return list({(values["proteome"], values.get("name")): values for values in lines}.values())
@@ -0,0 +1,152 @@
+"""
+Vectorized moment invariants of KMER_CUT and RADIUS fragments, the fragments used for shapemers.
+
+Computes the same moments as geometricus' MomentInvariants.from_coordinates with
+split_type=SplitType.KMER_CUT, split_size=16 and split_type=SplitType.RADIUS, split_size=10
+(moment types O_3, O_4, O_5 and F), for any number of alpha carbon traces at once:
+fragments of all traces are gathered into one padded (n_fragments, max_fragment_size, 3) array
+and their central moments are computed with array operations instead of one Python call per fragment.
+Radius neighbourhoods of a trace come from a single KD-tree pair query.
+
+Radius fragment residues are summed in index order rather than geometricus' KD-tree order,
+so moments can differ in the last bits, and shapemers only if a moment lies within that difference of a bin edge.
+"""
+
+import typing as ty
+
+import numpy as np
+from scipy.spatial import cKDTree
+
+KMER_SIZE = 16
+RADIUS = 10
+
+
+def get_kmer_fragments(length: int, kmer_size: int = KMER_SIZE) -> np.ndarray:
+    """
+    (n_fragments, kmer_size) residue indices of the KMER_CUT fragments of a trace of `length` residues:
+    windows centred on residues kmer_size // 2 to length - kmer_size // 2 - 1
+    """
+    num_fragments = max(0, length - 2 * (kmer_size // 2))
+    return np.arange(num_fragments)[:, None] + np.arange(kmer_size)[None, :]
+
+
+def get_radius_fragments(coords: np.ndarray, radius: float = RADIUS) -> ty.Tuple[np.ndarray, np.ndarray]:
+    """
+    Residue indices of the RADIUS fragment of each residue (all residues within `radius`, itself included),
+    padded to the largest fragment.
+
+    Returns
+    -------
+    (n_residues, max_fragment_size) indices, and a mask of the same shape, False for padding
+    """
+    num_residues = coords.shape[0]
+    pairs = cKDTree(coords).query_pairs(radius, output_type="ndarray")
+    rows = np.concatenate([pairs[:, 0], pairs[:, 1], np.arange(num_residues)])
+    columns = np.concatenate([pairs[:, 1], pairs[:, 0], np.arange(num_residues)])
+    order = np.lexsort((columns, rows))
+    rows, columns = rows[order], columns[order]
+    sizes = np.bincount(rows, minlength=num_residues)
+    starts = np.concatenate([[0], np.cumsum(sizes)[:-1]])
+    ranks = np.arange(rows.shape[0]) - starts[rows]
+    indices = np.zeros((num_residues, sizes.max(initial=0)), dtype=np.int64)
+    mask = np.zeros(indices.shape, dtype=bool)
+    indices[rows, ranks] = columns
+    mask[rows, ranks] = True
+    return indices, mask
+
+
+def get_fragment_moments(coords: np.ndarray, indices: np.ndarray, mask: np.ndarray = None) -> np.ndarray:
+    """
+    (n_fragments, 4) O_3, O_4, O_5 and F moment invariants of the fragments `coords[indices[i][mask[i]]]`
+    """
+    # fragment residues along the first axis: numpy sums over it one row after the other,
+    # the same order as geometricus' (numba) sums, so kmer moments mostly match to the last bit
+    fragments = coords[indices.T]
+    if mask is None:
+        centroids = fragments.sum(axis=0) / indices.shape[1]
+        deviations = fragments - centroids
+    else:
+        weights = mask.T[:, :, None]
+        centroids = np.where(weights, fragments, 0.).sum(axis=0) / mask.sum(axis=1)[:, None]
+        deviations = np.where(weights, fragments - centroids, 0.)
+    x, y, z = deviations[..., 0], deviations[..., 1], deviations[..., 2]
+    xx, yy, zz = x * x, y * y, z * z
+    mu_200, mu_020, mu_002 = xx.sum(axis=0), yy.sum(axis=0), zz.sum(axis=0)
+    mu_110, mu_101, mu_011 = (x * y).sum(axis=0), (x * z).sum(axis=0), (y * z).sum(axis=0)
+    mu_300, mu_030, mu_003 = (xx * x).sum(axis=0), (yy * y).sum(axis=0), (zz * z).sum(axis=0)
+    mu_210, mu_201, mu_120 = (xx * y).sum(axis=0), (xx * z).sum(axis=0), (x * yy).sum(axis=0)
+    mu_021, mu_102, mu_012 = (yy * z).sum(axis=0), (x * zz).sum(axis=0), (y * zz).sum(axis=0)
+    mu_111 = (x * y * z).sum(axis=0)
+    # formulas as written in geometricus.moment_utility
+    o_3 = mu_200 + mu_020 + mu_002
+    o_4 = (mu_200 * mu_020 * mu_002
+           + 2 * mu_110 * mu_101 * mu_011
+           - mu_002 * mu_110 ** 2
+           - mu_020 * mu_101 ** 2
+           - mu_200 * mu_011 ** 2)
+    o_5 = (mu_200 * mu_020
+           + mu_200 * mu_002
+           + mu_020 * mu_002
+           - mu_110 ** 2
+           - mu_101 ** 2
+           - mu_011 ** 2)
+    f = (mu_003 ** 2
+         + 6 * mu_012 ** 2
+         + 6 * mu_021 ** 2
+         + mu_030 ** 2
+         + 6 * mu_102 ** 2
+         + 15 * mu_111 ** 2
+         - 3 * mu_102 * mu_120
+         + 6 * mu_120 ** 2
+         - 3 * mu_021 * mu_201
+         + 6 * mu_201 ** 2
+         - 3 * mu_003 * (mu_021 + mu_201)
+         - 3 * mu_030 * mu_210
+         + 6 * mu_210 ** 2
+         - 3 * mu_012 * (mu_030 + mu_210)
+         - 3 * mu_102 * mu_300
+         - 3 * mu_120 * mu_300
+         + mu_300 ** 2)
+    return np.stack([o_3, o_4, o_5, f], axis=1)
+
+
+def get_moments(coords_list: ty.Sequence[np.ndarray], kmer_size: int = KMER_SIZE, radius: float = RADIUS,
+                block_size: int = 1 << 16) -> ty.Tuple[ty.List[np.ndarray], ty.List[np.ndarray]]:
+    """
+    KMER_CUT and RADIUS moment invariants of each trace (e.g. segment or protein) in `coords_list`.
+    Fragments of all traces are computed together, about `block_size` residue slots
+    (n_fragments * max_fragment_size) at a time.
+
+    Returns
+    -------
+    list of (n_kmer_fragments, 4) and list of (n_residues, 4) arrays, one per trace
+    """
+    coords_list = [np.asarray(coords, dtype=np.float64).reshape(-1, 3) for coords in coords_list]
+    all_coords = np.concatenate([np.zeros((0, 3))] + coords_list)
+    starts = np.concatenate([[0], np.cumsum([coords.shape[0] for coords in coords_list])])
+    kmer_indices = np.concatenate([np.zeros((0, kmer_size), dtype=np.int64)] +
+                                  [get_kmer_fragments(coords.shape[0], kmer_size) + start
+                                   for coords, start in zip(coords_list, starts)])
+    kmer_moments = _get_block_moments(all_coords, kmer_indices, None, block_size)
+
+    radius_fragments = [get_radius_fragments(coords, radius) for coords in coords_list]
+    width = max([indices.shape[1] for indices, _ in radius_fragments], default=0)
+    radius_indices = np.zeros((all_coords.shape[0], width), dtype=np.int64)
+    radius_mask = np.zeros(radius_indices.shape, dtype=bool)
+    for (indices, mask), start in zip(radius_fragments, starts):
+        radius_indices[start: start + indices.shape[0], :indices.shape[1]] = indices + start
+        radius_mask[start: start + indices.shape[0], :indices.shape[1]] = mask
+    radius_moments = _get_block_moments(all_coords, radius_indices, radius_mask, block_size)
+
+    kmer_starts = np.concatenate([[0], np.cumsum([max(0, coords.shape[0] - 2 * (kmer_size // 2))
+                                                  for coords in coords_list])])
+    return ([kmer_moments[kmer_starts[i]: kmer_starts[i + 1]] for i in range(len(coords_list))],
+            [radius_moments[starts[i]: starts[i + 1]] for i in range(len(coords_list))])
+
+
+def _get_block_moments(coords, indices, mask, block_size):
+    num_rows = max(1, block_size // max(1, indices.shape[1]))
+    return np.concatenate([np.zeros((0, 4))] +
+                          [get_fragment_moments(coords, indices[start: start + num_rows],
+                                                None if mask is None else mask[start: start + num_rows])
+                           for start in range(0, indices.shape[0], num_rows)])
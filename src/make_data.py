@@ -1,44 +1,36 @@
 from pathlib import Path
-from ftplib import FTP
 import prody as pd
-from dataclasses import dataclass
 import numpy as np
-import typing as ty
-from geometricus import MomentInvariants, SplitType
 import tarfile
-from time import time
+import gzip
+import io
+import multiprocessing
+from contextlib import nullcontext
+from functools import partial
 from tqdm import tqdm
 from scipy import ndimage
 
-from src import uniprot_parser, proteinnet_parser
+from src import uniprot_parser, proteinnet_parser, pdb_parser, corpus, moments, archives, download, coordinates, \
+    invariants, instrumentation
+from src.instrumentation import Instrumentation, MalformedStructureError, run_instrumented
+from src.sharding import Shard, merge_shards, temporary_shard
 
 UNIPROT_COLUMNS = ",".join(("id", "entry name", 'genes', 'genes(PREFERRED)', 'genes(ALTERNATIVE)',
                         'genes(OLN)', 'genes(ORF)', "organism", "protein names", "families",
                         'go', 'go(biological process)', 'go(molecular function)',
                         'go(cellular component)', 'database(PDB)', 'database(Pfam)'))
+# ProteinNet sections needed for shapemers and coordinates, the rest are skipped while parsing
+PROTEINNET_FIELDS = ("primary", "tertiary", "mask")
 
 
-@dataclass
-class MomentInvariantsSavable:
-    name: str
-    moments: ty.Union[np.ndarray, None]
-    coordinates: ty.Union[np.ndarray, None]
-
-    @classmethod
-    def from_invariant(cls, invariant: MomentInvariants):
-        return cls(invariant.name, invariant.moments, invariant.coordinates)
-
-
-def download_data(output_folder: Path):
-    if not output_folder.exists():
-        output_folder.mkdir()
-    ftp = FTP('ftp.ebi.ac.uk')
-    ftp.login()
-    ftp.cwd("/pub/databases/alphafold")
-    for filename in ftp.nlst():
-        print(f"Retrieving {filename}")
-        with open(output_folder / filename, 'wb') as f:
-            ftp.retrbinary('RETR ' + filename, f.write)
+def download_data(output_folder: Path, num_connections=4, checksum_file=None,
+                  host=download.FTP_HOST, port=21, folder=download.FTP_FOLDER):
+    """
+    Mirror the AlphaFold FTP folder into `output_folder`, see `download.download_folder`.
+    Files that are already complete are skipped and partial files are resumed.
+    """
+    return download.download_folder(output_folder, host=host, port=port, folder=folder,
+                                    num_connections=num_connections, checksum_file=checksum_file)
 
 
 def extract_data(input_folder, output_folder):
@@ -51,124 +43,508 @@ def extract_data(input_folder, output_folder):
         tar.close()
 
 
-def get_uniprot_info(data_folder, aux_folder, extension="pdb.gz"):
-    start_time = time()
-    for folder in data_folder.iterdir():
-        if folder.is_dir() and folder.stem.startswith("UP0"):
-            uniprot_file = aux_folder / f"{folder.stem}_uniprot.txt"
-            uniprot_ids = [filename.stem.split("-")[1] for filename in folder.glob(f"*{extension}")]
-            if not uniprot_file.exists():
+def get_uniprot_info(data_folder, aux_folder, extension="pdb.gz", from_archives=False, num_workers=4, monitor=None):
+    """
+    Query UniProt for the models of each proteome in `data_folder` into `aux_folder`/<proteome>_uniprot.txt,
+    skipping proteomes that already have one.
+    Per-proteome timings are appended to uniprot_metrics.jsonl in `aux_folder`,
+    unless another `instrumentation.Instrumentation` is given as `monitor`.
+    """
+    if monitor is None:
+        monitor = Instrumentation(aux_folder / "uniprot_metrics.jsonl")
+    proteomes = archives.get_proteome_archives(data_folder) if from_archives else get_proteome_folders(data_folder)
+    for proteome in proteomes:
+        monitor.start_proteome(proteome.stem)
+        uniprot_file = aux_folder / f"{proteome.stem}_uniprot.txt"
+        with monitor.timer("list"):
+            uniprot_ids = [filename.stem.split("-")[1] for filename in get_proteome_structures(proteome, extension)]
+        monitor.add_files(len(uniprot_ids))
+        if not uniprot_file.exists():
+            with monitor.timer("uniprot"):
                 uniprot_parser.get_uniprot_info_from_ids(uniprot_ids, uniprot_file, chunk=True,
-                                                         columns=UNIPROT_COLUMNS)
-            print(f"{folder.stem}: Time elapsed: {time() - start_time}s")
+                                                         columns=UNIPROT_COLUMNS,
+                                                         cache_file=aux_folder / "uniprot_cache.sqlite",
+                                                         num_workers=num_workers)
+        monitor.end_proteome()
+
+
+def _read_structure(source):
+    """
+    Key and `pdb_parser.parse_ca` input of a model file or `archives.TarMember`
+    """
+    if isinstance(source, archives.TarMember):
+        with instrumentation.timer("read"):
+            contents = source.read()
+        instrumentation.count(bytes_read=len(contents))
+        return source.stem, contents
+    instrumentation.count(bytes_read=Path(source).stat().st_size)
+    return Path(source).stem, source
+
+
+def _parse_ca(contents, key, all_atom_betas=False):
+    """
+    `pdb_parser.parse_ca` in float64, raising a MalformedStructureError for models without alpha carbons
+    """
+    with instrumentation.timer("parse"):
+        pdb = pdb_parser.parse_ca(contents, key, all_atom_betas=all_atom_betas, dtype=np.float64)
+    if pdb is None:
+        raise MalformedStructureError("no alpha carbons")
+    instrumentation.count(num_residues=len(pdb))
+    return pdb
+
+
+def _parse_prody(source):
+    if isinstance(source, archives.TarMember):
+        return pd.parsePDBStream(io.StringIO(gzip.decompress(source.read()).decode()))
+    return pd.parsePDB(str(source))
+
+
+def get_coords_moments(key, coords, sequence):
+    """
+    Moment invariants of the KMER_CUT (size 16) and RADIUS (size 10) fragments of a set of alpha carbon coordinates,
+    as computed by geometricus, see `invariants.get_moments`.
+
+    Returns
+    -------
+    (n_kmer_fragments, 4) and (n_radius_fragments, 4) arrays
+    """
+    with instrumentation.timer("moments"):
+        kmer_moments, radius_moments = invariants.get_moments([coords])
+    return kmer_moments[0], radius_moments[0]
+
+
+def moments_to_shapemers(kmer_moments, radius_moments, resolution_kmer=4, resolution_radius=6):
+    """
+    Shapemers encoded with `corpus.encode_shapemers`, kmer shapemers first.
+    """
+    return np.concatenate([corpus.encode_shapemers(moments.discretize(kmer_moments, resolution_kmer)),
+                           corpus.encode_shapemers(moments.discretize(radius_moments, resolution_radius),
+                                                   radius=True)])
+
+
+def get_coords_shapemers(key, coords, sequence, resolution_kmer=4, resolution_radius=6):
+    """
+    Shapemers of a set of alpha carbon coordinates, see `get_coords_moments` and `moments_to_shapemers`.
+    """
+    return moments_to_shapemers(*get_coords_moments(key, coords, sequence), resolution_kmer, resolution_radius)
+
+
+def get_structure_moments(key, coords, betas, sequence, length_threshold=50):
+    """
+    Moment invariants (see `get_coords_moments`) of all high-confidence (smoothed pLDDT >= 70) segments
+    longer than `length_threshold` in one structure, concatenated over segments.
+    """
+    with instrumentation.timer("segment"):
+        betas = ndimage.gaussian_filter1d(betas, sigma=5)
+
+        indices = np.ones(betas.shape[0], dtype=int)
+        indices[np.where(betas < 70)] = 0
+
+        slices = ndimage.find_objects(ndimage.label(indices)[0])
+    instrumentation.add_segments(s.stop - s.start for s, in slices)
+    # all segments in one `invariants.get_moments` call
+    with instrumentation.timer("moments"):
+        kmer_moments, radius_moments = invariants.get_moments([coords[s.start: s.stop] for s, in slices
+                                                               if s.stop - s.start > length_threshold])
+    return np.concatenate([np.zeros((0, 4))] + kmer_moments), np.concatenate([np.zeros((0, 4))] + radius_moments)
+
+
+def get_structure_shapemers(key, coords, betas, sequence,
+                            resolution_kmer=4,
+                            resolution_radius=6,
+                            length_threshold=50):
+    """
+    Shapemers of all high-confidence segments longer than `length_threshold` in one structure,
+    see `get_structure_moments` and `moments_to_shapemers`.
+    """
+    return moments_to_shapemers(*get_structure_moments(key, coords, betas, sequence, length_threshold),
+                                resolution_kmer, resolution_radius)
+
+
+def get_AF_file_shapemers(pdb_file,
+                          resolution_kmer=4,
+                          resolution_radius=6,
+                          length_threshold=50,
+                          use_prody=False):
+    """
+    Shapemers of one AlphaFold model, see `get_structure_shapemers`.
+    The model is read with `pdb_parser.parse_ca` unless `use_prody` is set.
+
+    Returns
+    -------
+    (key, shapemer codes), empty if no segment is long enough
+
+    Raises
+    ------
+    MalformedStructureError if the model has no alpha carbons
+    """
+    key, contents = _read_structure(pdb_file)
+    if use_prody:
+        with instrumentation.timer("parse"):
+            pdb = _parse_prody(pdb_file)
+            pdb = pdb.select("protein and calpha") if pdb is not None else None
+        if pdb is None:
+            raise MalformedStructureError("no alpha carbons")
+        instrumentation.count(num_residues=len(pdb))
+        betas, coords, sequence = pdb.getBetas(), pdb.getCoords(), pdb.getSequence()
+    else:
+        pdb = _parse_ca(contents, key)
+        betas, coords, sequence = pdb.betas, pdb.coordinates, pdb.sequence
+    return key, get_structure_shapemers(key, coords, betas, sequence,
+                                        resolution_kmer, resolution_radius, length_threshold)
+
+
+def scan_AF_file(pdb_file, length_threshold=50, return_structure=False):
+    """
+    Statistics (as in `get_AF_file_information`) and moment invariants (as in `get_structure_moments`)
+    of one AlphaFold model from a single parse.
+
+    Returns
+    -------
+    (key, (median score, full length, high confidence length), kmer moments, radius moments)
+    followed by the parsed `pdb_parser.CAStructure` if `return_structure` is set
+
+    Raises
+    ------
+    MalformedStructureError if the model has no alpha carbons
+    """
+    key, contents = _read_structure(pdb_file)
+    pdb = _parse_ca(contents, key, all_atom_betas=True)
+    information = (np.median(pdb.atom_betas), len(pdb), int(np.sum(pdb.betas > 70)))
+    result = (key, information) + get_structure_moments(key, pdb.coordinates, pdb.betas, pdb.sequence,
+                                                        length_threshold)
+    if return_structure:
+        pdb.atom_betas = None
+        result += (pdb,)
+    return result
+
+
+def get_proteome_folders(root_folder):
+    return sorted(folder for folder in Path(root_folder).iterdir() if folder.is_dir() and folder.stem.startswith("UP0"))
+
+
+def get_proteome_structures(proteome, extension="pdb.gz"):
+    """
+    Sorted model files of an extracted proteome folder, or `archives.TarMember`s of a proteome archive
+    """
+    if Path(proteome).is_dir():
+        return sorted(Path(proteome).glob(f"*{extension}"))
+    return archives.load_tar_index(proteome, extension)
+
+
+def scan_proteomes(root_folder, shard_folder, process_function, write_function, streams,
+                   num_workers=1, chunk_size=16, checkpoint_interval=1000, from_archives=False,
+                   monitor=None):
+    """
+    Run `process_function` on every *.pdb.gz file of every UP0* proteome in `root_folder`
+    and pass each result, in sorted filename order, to `write_function(shard, result)`.
+
+    Each proteome writes to its own `Shard` in `shard_folder`, checkpointed every `checkpoint_interval` files,
+    so a rerun skips finished proteomes and resumes unfinished ones where they stopped.
+
+    Files for which `process_function` raises a data error (see `instrumentation.QUARANTINE_ERRORS`)
+    are quarantined with the error as reason and skipped, instead of aborting the run.
+    Stage timings and counts of each proteome are appended to metrics.jsonl
+    and quarantined files to quarantine.tsv in `shard_folder`, unless `monitor` is given.
+
+    Parameters
+    ----------
+    root_folder
+        folder with UP0* proteome folders, or UP0*.tar proteome archives
+    shard_folder
+        folder to write shards and checkpoints to
+    process_function
+        picklable function taking a filename or `archives.TarMember`
+    write_function
+        function taking a Shard and the output of process_function
+    streams
+        names of the output streams of each shard
+    num_workers
+        number of processes, 1 runs everything in this process
+    chunk_size
+        number of files sent to a worker at a time
+    from_archives
+        read models straight from the UP0*.tar archives (see `archives.load_tar_index`) instead of extracted folders
+    monitor
+        `instrumentation.Instrumentation` receiving the per-file records and per-proteome metrics
+
+    Returns
+    -------
+    list of Shards, one per proteome, in sorted proteome order
+    """
+    if monitor is None:
+        shard_folder = Path(shard_folder)
+        shard_folder.mkdir(parents=True, exist_ok=True)
+        monitor = Instrumentation(shard_folder / "metrics.jsonl", shard_folder / "quarantine.tsv")
+    process_function = partial(run_instrumented, process_function)
+    shards = []
+    proteomes = archives.get_proteome_archives(root_folder) if from_archives else get_proteome_folders(root_folder)
+    with (multiprocessing.Pool(num_workers) if num_workers > 1 else nullcontext()) as pool:
+        for proteome in proteomes:
+            shard = Shard(shard_folder, proteome.stem, streams)
+            shards.append(shard)
+            if shard.complete:
+                print(f"{proteome.stem}: done")
+                continue
+            print(proteome.stem)
+            monitor.start_proteome(proteome.stem)
+            filenames = get_proteome_structures(proteome)
+            remaining = filenames[shard.num_done:]
+            if pool is None:
+                results = map(process_function, remaining)
+            else:
+                results = pool.imap(process_function, remaining, chunksize=chunk_size)
+            with shard:
+                for num_done, (result, record) in enumerate(tqdm(results, total=len(remaining)),
+                                                             start=shard.num_done + 1):
+                    monitor.add(record)
+                    if record.error is None:
+                        with monitor.timer("write"):
+                            write_function(shard, result)
+                    if num_done % checkpoint_interval == 0:
+                        shard.checkpoint(num_done)
+                shard.checkpoint(len(filenames), complete=True)
+            monitor.end_proteome()
+    return shards
+
+
+def _write_corpus_document(shard, result):
+    key, shapemers = result
+    if len(shapemers):
+        corpus.write_document(shard, key, shapemers)
 
 
 def get_AF_shapemers(root_folder,
                      resolution_kmer=4,
                      resolution_radius=6,
-                     length_threshold=50):
+                     length_threshold=50,
+                     num_workers=1,
+                     chunk_size=16,
+                     export_text=False,
+                     from_archives=False,
+                     monitor=None):
+    """
+    Writes shapemers of all AlphaFold models in the UP0* proteome folders of `root_folder`
+    to a binary corpus folder (see `corpus.write_binary_corpus`), one document per model.
+
+    Each proteome is processed into its own checkpointed shard (see `scan_proteomes`),
+    shards are merged in sorted proteome order so the output does not depend on `num_workers`.
+    If `export_text` is set the corpus is also written in the text format.
+    If `from_archives` is set models are read straight from UP0*.tar proteome archives.
+    Models without alpha carbons are listed in quarantine.tsv, and per-proteome metrics in metrics.jsonl,
+    of the shard folder, unless another `instrumentation.Instrumentation` is given as `monitor`.
+    """
+    root_folder = Path(root_folder)
+    suffix = f"resolution_{resolution_kmer}_{resolution_radius}_threshold_{length_threshold}"
+    shards = scan_proteomes(root_folder,
+                            root_folder / f"AF_corpus_shards_{suffix}",
+                            partial(get_AF_file_shapemers,
+                                    resolution_kmer=resolution_kmer,
+                                    resolution_radius=resolution_radius,
+                                    length_threshold=length_threshold),
+                            _write_corpus_document,
+                            corpus.STREAMS,
+                            num_workers=num_workers,
+                            chunk_size=chunk_size,
+                            from_archives=from_archives,
+                            monitor=monitor)
+    corpus.write_binary_corpus(shards, root_folder / f"AF_corpus_{suffix}")
+    if export_text:
+        corpus.export_text_corpus(corpus.load_binary_corpus(root_folder / f"AF_corpus_{suffix}"),
+                                  root_folder / f"AF_ids_corpus_{suffix}.txt")
+
+
+def _write_scan_result(shard, result, resolution_kmer=4, resolution_radius=6, save_moments=True):
+    key, (avg_score, length_full, length_high_confidence), kmer_moments, radius_moments, *structure = result
+    if structure:
+        coordinates.write_coordinates(shard, key, structure[0].coordinates, structure[0].betas, structure[0].sequence)
+    shard.write("tsv", f"{key}\t{avg_score}\t{length_full}\t{length_high_confidence}\n".encode())
+    _write_corpus_document(shard, (key, moments_to_shapemers(kmer_moments, radius_moments,
+                                                             resolution_kmer, resolution_radius)))
+    if save_moments and kmer_moments.shape[0] + radius_moments.shape[0]:
+        moments.write_moments(shard, key, kmer_moments, radius_moments)
+
+
+def scan_AF_structures(root_folder,
+                       resolution_kmer=4,
+                       resolution_radius=6,
+                       length_threshold=50,
+                       num_workers=1,
+                       chunk_size=16,
+                       export_text=False,
+                       save_moments=True,
+                       save_coordinates=False,
+                       from_archives=False,
+                       monitor=None):
+    """
+    Single pass over all AlphaFold models in the UP0* proteome folders of `root_folder` that writes
+    the shapemer corpus (same output as `get_AF_shapemers`),
+    a tab-separated table of per-protein statistics (AF_protein_information.txt) with columns
+    ID, "Avg. score", "Length" and "High confidence length", ready to be joined to AF_dataframe with
+
+    >>> pnd.read_csv(root_folder / "AF_protein_information.txt", sep="\t", index_col="ID")
+
+    and, if `save_moments` is set, a moment store (see `moments.write_moment_store`)
+    from which corpora at other resolutions can be made with `moments.write_corpus`,
+    and, if `save_coordinates` is set, a coordinate store (see `coordinates.write_coordinate_store`)
+    of the alpha carbon coordinates, pLDDT values and sequences of all models (AF_coordinates).
+
+    Uses the same sharding, checkpointing, parallelism, quarantine and `from_archives` option as `get_AF_shapemers`.
+    """
     root_folder = Path(root_folder)
-    with open(
-            root_folder /
-            f"AF_ids_corpus_resolution_{resolution_kmer}_{resolution_radius}_threshold_{length_threshold}.txt",
-            "w") as corpus_file:
-        for folder in root_folder.iterdir():
-            if folder.is_dir() and folder.stem.startswith("UP0"):
-                print(folder.stem)
-                for i, pdb_file in tqdm(enumerate(folder.glob("*.pdb.gz"))):
-                    key = pdb_file.stem
-                    pdb = pd.parsePDB(str(pdb_file)).select("protein and calpha")
-                    betas = ndimage.gaussian_filter1d(pdb.getBetas(), sigma=5)
-                    coords = pdb.getCoords()
-                    sequence = pdb.getSequence()
-
-                    indices = np.ones(betas.shape[0], dtype=int)
-                    indices[np.where(betas < 70)] = 0
-
-                    slices = ndimage.find_objects(ndimage.label(indices)[0])
-                    index = 0
-                    shapemers = []
-                    for s in slices:
-                        s = s[0]
-                        if s.stop - s.start > length_threshold:
-                            index += 1
-                            invariants = MomentInvariants.from_coordinates(
-                                key,
-                                coords[s.start: s.stop],
-                                sequence[s.start: s.stop],
-                                split_type=SplitType.KMER_CUT,
-                                split_size=16
-                            )
-                            shapemers += [f"k{x[0]}i{x[1]}i{x[2]}i{x[3]}" for x in
-                                          (np.log1p(invariants.moments) * resolution_kmer).astype(int)]
-                            invariants = MomentInvariants.from_coordinates(
-                                key,
-                                coords[s.start: s.stop],
-                                sequence[s.start: s.stop],
-                                split_type=SplitType.RADIUS,
-                                split_size=10
-                            )
-                            shapemers += [f"r{x[0]}i{x[1]}i{x[2]}i{x[3]}" for x in
-                                          (np.log1p(invariants.moments) * resolution_radius).astype(int)]
-                    if index > 0:
-                        corpus_file.write(key + "\t" + " ".join(shapemers) + "\n")
-
-
-def get_PDB_shapemers(casp_file, root_folder, resolution_kmer=4, resolution_radius=6):
-    with open(Path(root_folder) / f"PDB_{casp_file.stem}_ids_corpus_resolution_{resolution_kmer}_{resolution_radius}.txt",
-              "w") as corpus_file:
-        for entry in tqdm(proteinnet_parser.yield_records_from_file(casp_file, 20)):
-            entry = proteinnet_parser.clean_entry(entry, 'ca')
-            invariants = MomentInvariants.from_coordinates(
-                entry["ID"],
-                entry["tertiary"],
-                entry["primary"],
-                split_type=SplitType.KMER_CUT,
-                split_size=16
-            )
-            shapemers = [f"k{x[0]}i{x[1]}i{x[2]}i{x[3]}" for x in
-                         (np.log1p(invariants.moments) * resolution_kmer).astype(int)]
-            invariants = MomentInvariants.from_coordinates(
-                entry["ID"],
-                entry["tertiary"],
-                entry["primary"],
-                split_type=SplitType.RADIUS,
-                split_size=10
-            )
-            shapemers += [f"r{x[0]}i{x[1]}i{x[2]}i{x[3]}" for x in
-                          (np.log1p(invariants.moments) * resolution_radius).astype(int)]
-            if len(shapemers):
-                corpus_file.write(entry["ID"] + "\t" + " ".join(shapemers) + "\n")
-
-
-def get_AF_protein_information(data_folder):
+    suffix = f"resolution_{resolution_kmer}_{resolution_radius}_threshold_{length_threshold}"
+    shards = scan_proteomes(root_folder,
+                            root_folder / f"AF_scan_shards_{suffix}",
+                            partial(scan_AF_file, length_threshold=length_threshold,
+                                    return_structure=save_coordinates),
+                            partial(_write_scan_result,
+                                    resolution_kmer=resolution_kmer,
+                                    resolution_radius=resolution_radius,
+                                    save_moments=save_moments),
+                            corpus.STREAMS + ["tsv"] + (moments.STREAMS if save_moments else []) +
+                            (coordinates.get_streams() if save_coordinates else []),
+                            num_workers=num_workers,
+                            chunk_size=chunk_size,
+                            from_archives=from_archives,
+                            monitor=monitor)
+    corpus.write_binary_corpus(shards, root_folder / f"AF_corpus_{suffix}")
+    merge_shards(shards, "tsv", root_folder / "AF_protein_information.txt",
+                 header=b"ID\tAvg. score\tLength\tHigh confidence length\n")
+    if save_moments:
+        moments.write_moment_store(shards, root_folder / f"AF_moments_threshold_{length_threshold}")
+    if save_coordinates:
+        coordinates.write_coordinate_store(shards, root_folder / "AF_coordinates")
+    if export_text:
+        corpus.export_text_corpus(corpus.load_binary_corpus(root_folder / f"AF_corpus_{suffix}"),
+                                  root_folder / f"AF_ids_corpus_{suffix}.txt")
+
+
+def _get_PDB_entry_moments(entry):
+    with instrumentation.timer("parse"):
+        entry = proteinnet_parser.clean_entry(entry, 'ca')
+    instrumentation.count(num_residues=entry["tertiary"].shape[0])
+    return (entry["ID"],) + get_coords_moments(entry["ID"], entry["tertiary"], entry["primary"])
+
+
+def get_PDB_shapemers(casp_file, root_folder, resolution_kmer=4, resolution_radius=6, export_text=False,
+                      save_moments=True, monitor=None):
+    """
+    Writes shapemers of all ProteinNet records in `casp_file` to a binary corpus folder, one document per record,
+    and, if `save_moments` is set, their moment invariants to a moment store folder.
+    If `export_text` is set the corpus is also written in the text format.
+    Records that cannot be processed are quarantined as in `scan_proteomes`,
+    to quarantine.tsv and metrics.jsonl in the corpus folder unless `monitor` is given.
+    """
+    root_folder = Path(root_folder)
+    name = f"PDB_{casp_file.stem}_corpus_resolution_{resolution_kmer}_{resolution_radius}"
+    (root_folder / name).mkdir(parents=True, exist_ok=True)
+    if monitor is None:
+        monitor = Instrumentation(root_folder / name / "metrics.jsonl", root_folder / name / "quarantine.tsv")
+    monitor.start_proteome(casp_file.stem)
+    with temporary_shard(root_folder / name, "shapemers",
+                         corpus.STREAMS + (moments.STREAMS if save_moments else [])) as shard:
+        with shard:
+            for entry in tqdm(proteinnet_parser.yield_records_from_file(casp_file, 20, PROTEINNET_FIELDS)):
+                result, record = run_instrumented(_get_PDB_entry_moments, entry)
+                monitor.add(record)
+                if record.error is not None:
+                    continue
+                key, kmer_moments, radius_moments = result
+                with monitor.timer("write"):
+                    _write_corpus_document(shard, (key, moments_to_shapemers(kmer_moments, radius_moments,
+                                                                             resolution_kmer, resolution_radius)))
+                    if save_moments and kmer_moments.shape[0] + radius_moments.shape[0]:
+                        moments.write_moments(shard, key, kmer_moments, radius_moments)
+        monitor.end_proteome()
+        corpus.write_binary_corpus([shard], root_folder / name)
+        if save_moments:
+            moments.write_moment_store([shard], root_folder / f"PDB_{casp_file.stem}_moments")
+    if export_text:
+        corpus.export_text_corpus(corpus.load_binary_corpus(root_folder / name),
+                                  root_folder / f"PDB_{casp_file.stem}_ids_corpus_resolution_{resolution_kmer}_{resolution_radius}.txt")
+
+
+def get_AF_file_information(filename, use_prody=False):
+    """
+    Median pLDDT over all atoms, number of residues and number of residues with pLDDT > 70 of one AlphaFold model.
+    The model is read with `pdb_parser.parse_ca` unless `use_prody` is set.
+
+    Returns
+    -------
+    (key, median score, full length, high confidence length), values are None if they could not be computed
+
+    Raises
+    ------
+    MalformedStructureError if the model has no alpha carbons (or no atoms, with prody)
+    """
+    key, contents = _read_structure(filename)
+    if not use_prody:
+        pdb = _parse_ca(contents, key, all_atom_betas=True)
+        num_high_confidence = int(np.sum(pdb.betas > 70))
+        return key, np.median(pdb.atom_betas), len(pdb), num_high_confidence if num_high_confidence else None
+    with instrumentation.timer("parse"):
+        pdb = _parse_prody(filename)
+    if pdb is None:
+        raise MalformedStructureError("no atoms")
+    avg_score = np.median(pdb.getBetas())
+    pdb = pdb.select("protein and calpha")
+    if pdb is None:
+        return key, avg_score, None, None
+    length_full = len(pdb)
+    instrumentation.count(num_residues=length_full)
+    pdb = pdb.select("beta > 70")
+    if pdb is None:
+        return key, avg_score, length_full, None
+    return key, avg_score, length_full, len(pdb)
+
+
+def get_AF_protein_information(data_folder, use_prody=False, monitor=None):
+    """
+    Median pLDDT, number of residues and number of high-confidence residues (see `get_AF_file_information`)
+    of all models in the UP0* proteome folders of `data_folder`, as three dicts keyed by model.
+    Models that cannot be read are reported to `monitor` (by default only printed) and skipped.
+    """
     data_folder = Path(data_folder)
+    if monitor is None:
+        monitor = Instrumentation()
     avg_scores = {}
     lengths_high_confidence = {}
     lengths_full = {}
     for folder in data_folder.iterdir():
         if folder.is_dir() and folder.stem.startswith("UP0"):
+            monitor.start_proteome(folder.stem)
             for filename in tqdm(folder.glob("*.pdb.gz")):
-                pdb = pd.parsePDB(str(filename))
-                if pdb is None:
-                    continue
-                key = filename.stem
-                avg_scores[key] = np.median(pdb.getBetas())
-                pdb = pdb.select("protein and calpha")
-                if pdb is None:
+                result, record = run_instrumented(partial(get_AF_file_information, use_prody=use_prody), filename)
+                monitor.add(record)
+                if record.error is not None:
                     continue
-                lengths_full[key] = len(pdb)
-                pdb = pdb.select("beta > 70")
-                if pdb is None:
-                    continue
-                lengths_high_confidence[key] = len(pdb)
+                key, avg_score, length_full, length_high_confidence = result
+                if avg_score is not None:
+                    avg_scores[key] = avg_score
+                if length_full is not None:
+                    lengths_full[key] = length_full
+                if length_high_confidence is not None:
+                    lengths_high_confidence[key] = length_high_confidence
+            monitor.end_proteome()
     return avg_scores, lengths_high_confidence, lengths_full
 
 
-def get_PDB_protein_information(casp_files):
-    coords = {}
-    for casp_file in casp_files:
-        for entry in tqdm(proteinnet_parser.yield_records_from_file(casp_file, 20)):
-            entry = proteinnet_parser.clean_entry(entry, 'ca')
-            coords[entry["ID"]] = entry["tertiary"]
-    return coords
+def write_PDB_coordinate_store(casp_files, output_folder):
+    """
+    Stream the alpha carbon coordinates and sequences of all ProteinNet records in `casp_files`
+    into a coordinate store folder (see `coordinates.write_coordinate_store`).
+    Looking up a repeated ID gives its last record.
+
+    Returns
+    -------
+    the memory-mapped `coordinates.CoordinateStore`
+    """
+    output_folder = Path(output_folder)
+    with temporary_shard(output_folder, "coordinates", coordinates.get_streams(plddt=False)) as shard:
+        with shard:
+            for casp_file in casp_files:
+                for entry in tqdm(proteinnet_parser.yield_records_from_file(casp_file, 20, PROTEINNET_FIELDS)):
+                    entry = proteinnet_parser.clean_entry(entry, 'ca')
+                    coordinates.write_coordinates(shard, entry["ID"], entry["tertiary"], sequence=entry["primary"])
+        coordinates.write_coordinate_store([shard], output_folder)
+    return coordinates.load_coordinate_store(output_folder)
@@ -0,0 +1,112 @@
+"""
+Store of raw moment invariants, so corpora at any shapemer resolution can be rebuilt without recomputing them.
+
+A moment store is a folder of .npy files in a ragged layout:
+ids (one per protein), and for each of the kmer and radius fragments
+a (n_fragments, 4) float32 array of moments with offsets (n_proteins + 1) into it.
+"""
+
+import typing as ty
+from dataclasses import dataclass
+from pathlib import Path
+
+import numpy as np
+from tqdm import tqdm
+
+from src import corpus
+from src.sharding import Shard, read_shard_lines, read_shard_offsets, save_shard_array, temporary_shard
+
+STREAMS = ["moment_ids", "kmer", "kmer_lengths", "radius", "radius_lengths"]
+
+
+def discretize(moments: np.ndarray, resolution: float) -> np.ndarray:
+    """
+    Moment invariants to shapemer values, computed in float64 as in geometricus.
+    """
+    return (np.log1p(np.asarray(moments, dtype=np.float64)) * resolution).astype(int)
+
+
+@dataclass
+class MomentStore:
+    ids: np.ndarray
+    kmer_offsets: np.ndarray
+    kmer_moments: np.ndarray
+    radius_offsets: np.ndarray
+    radius_moments: np.ndarray
+
+    def __len__(self):
+        return self.ids.shape[0]
+
+    def __getitem__(self, index) -> ty.Tuple[np.ndarray, np.ndarray]:
+        return (self.kmer_moments[self.kmer_offsets[index]: self.kmer_offsets[index + 1]],
+                self.radius_moments[self.radius_offsets[index]: self.radius_offsets[index + 1]])
+
+
+def write_moments(shard: Shard, key: str, kmer_moments: np.ndarray, radius_moments: np.ndarray):
+    """
+    Append the moments of one protein to the `STREAMS` of a shard.
+    """
+    shard.write("moment_ids", (key + "\n").encode())
+    for name, moments in (("kmer", kmer_moments), ("radius", radius_moments)):
+        shard.write(name, np.ascontiguousarray(moments, dtype=np.float32).tobytes())
+        shard.write(f"{name}_lengths", np.int64(moments.shape[0]).tobytes())
+
+
+def write_moment_store(shards: ty.Sequence[Shard], output_folder: Path):
+    """
+    Merge the moment streams of `shards`, in the given order, into a moment store folder.
+    """
+    output_folder = Path(output_folder)
+    if not output_folder.exists():
+        output_folder.mkdir(parents=True)
+    np.save(output_folder / "ids.npy", np.array(read_shard_lines(shards, "moment_ids"), dtype=str))
+    for name in ("kmer", "radius"):
+        np.save(output_folder / f"{name}_offsets.npy", read_shard_offsets(shards, f"{name}_lengths"))
+        save_shard_array(shards, name, output_folder / f"{name}_moments.npy", np.float32, (4,))
+
+
+def load_moment_store(folder: Path, mmap_mode: ty.Union[str, None] = "r") -> MomentStore:
+    folder = Path(folder)
+    return MomentStore(*(np.load(folder / f"{name}.npy", mmap_mode=mmap_mode)
+                         for name in ("ids", "kmer_offsets", "kmer_moments", "radius_offsets", "radius_moments")))
+
+
+def _get_block_codes(store: MomentStore, start: int, stop: int, resolution_kmer: float, resolution_radius: float):
+    codes, documents = [], []
+    for name, offsets, moments, resolution in (("kmer", store.kmer_offsets, store.kmer_moments, resolution_kmer),
+                                               ("radius", store.radius_offsets, store.radius_moments,
+                                                resolution_radius)):
+        block_offsets = np.asarray(offsets[start: stop + 1])
+        codes.append(corpus.encode_shapemers(discretize(moments[block_offsets[0]: block_offsets[-1]], resolution),
+                                             radius=name == "radius"))
+        documents.append(np.repeat(np.arange(stop - start), np.diff(block_offsets)))
+    return np.concatenate(codes), np.concatenate(documents)
+
+
+def write_corpus(store: MomentStore, output_folder: Path, resolution_kmer: float = 4, resolution_radius: float = 6,
+                 block_size: int = 100_000):
+    """
+    Discretize all stored moments at the given resolutions and write them as a binary corpus folder
+    (see `corpus.write_binary_corpus`), `block_size` proteins at a time.
+
+    Moments are stored as float32 so a value that lies within float32 rounding of a shapemer bin edge
+    can end up in the neighbouring bin compared to a corpus computed directly from the coordinates.
+    """
+    output_folder = Path(output_folder)
+    with temporary_shard(output_folder, "moments", corpus.STREAMS) as shard:
+        with shard:
+            for start in tqdm(range(0, len(store), block_size)):
+                stop = min(start + block_size, len(store))
+                codes, documents = _get_block_codes(store, start, stop, resolution_kmer, resolution_radius)
+                order = np.lexsort((codes, documents))
+                codes, documents = codes[order], documents[order]
+                is_new = np.ones(codes.shape[0], dtype=bool)
+                is_new[1:] = (codes[1:] != codes[:-1]) | (documents[1:] != documents[:-1])
+                starts = np.flatnonzero(is_new)
+                counts = np.diff(np.append(starts, codes.shape[0]))
+                shard.write("ids", "".join(f"{key}\n" for key in store.ids[start: stop]).encode())
+                shard.write("codes", codes[starts].astype(np.int64).tobytes())
+                shard.write("counts", counts.astype(np.int32).tobytes())
+                shard.write("lengths",
+                            np.bincount(documents[starts], minlength=stop - start).astype(np.int64).tobytes())
+        corpus.write_binary_corpus([shard], output_folder)
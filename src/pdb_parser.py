@@ -0,0 +1,90 @@
+"""
+Streaming alpha carbon reader for (gzipped) single-model PDB files, e.g. AlphaFold models.
+"""
+
+import gzip
+import io
+import typing as ty
+from dataclasses import dataclass
+from pathlib import Path
+
+import numpy as np
+
+THREE_TO_ONE = {'ALA': 'A', 'ARG': 'R', 'ASN': 'N', 'ASP': 'D', 'CYS': 'C', 'GLN': 'Q', 'GLU': 'E', 'GLY': 'G',
+                'HIS': 'H', 'ILE': 'I', 'LEU': 'L', 'LYS': 'K', 'MET': 'M', 'PHE': 'F', 'PRO': 'P', 'SER': 'S',
+                'THR': 'T', 'TRP': 'W', 'TYR': 'Y', 'VAL': 'V'}
+
+
+@dataclass
+class CAStructure:
+    name: str
+    coordinates: np.ndarray
+    """(n_residues, 3) alpha carbon coordinates"""
+    betas: np.ndarray
+    """(n_residues,) alpha carbon B-factors (pLDDT for AlphaFold models)"""
+    sequence: str
+    """one letter amino acid sequence, X for non-standard residues"""
+    atom_betas: ty.Union[np.ndarray, None] = None
+    """B-factors of all ATOM records, only filled if asked for"""
+
+    def __len__(self):
+        return self.coordinates.shape[0]
+
+
+def _open(source: ty.Union[str, Path, bytes]):
+    if isinstance(source, (bytes, bytearray, memoryview)):
+        handle = io.BytesIO(source)
+        return gzip.GzipFile(fileobj=handle) if bytes(source[:2]) == b"\x1f\x8b" else handle
+    if str(source).endswith(".gz"):
+        return gzip.open(source, "rb")
+    return open(source, "rb")
+
+
+def parse_ca(source: ty.Union[str, Path, bytes], name: str = None, all_atom_betas: bool = False,
+             dtype=np.float32) -> ty.Union[CAStructure, None]:
+    """
+    Read alpha carbon coordinates, B-factors and sequence from a PDB file, without building a full structure.
+
+    Only the first model is read. Keeps ATOM records with atom name CA and alternate location " " or "A",
+    the same atoms as ProDy's "protein and calpha" selection for AlphaFold models.
+
+    Parameters
+    ----------
+    source
+        path to a .pdb or .pdb.gz file, or the (gzipped) file contents
+    name
+        defaults to the file name without .gz
+    all_atom_betas
+        also collect B-factors of all ATOM records (e.g. for the median pLDDT over all atoms)
+    dtype
+        dtype of the returned coordinate and B-factor arrays
+
+    Returns
+    -------
+    CAStructure, or None if there are no alpha carbons
+    """
+    if name is None:
+        name = "" if isinstance(source, (bytes, bytearray, memoryview)) else Path(source).name
+        if name.endswith(".gz"):
+            name = name[:-3]
+    ca_fields = []
+    residue_names = []
+    atom_beta_fields = []
+    with _open(source) as f:
+        for line in f:
+            if line.startswith(b"ATOM"):
+                if all_atom_betas:
+                    atom_beta_fields.append(line[60:66])
+                if line[12:16] == b" CA " and line[16:17] in b" A":
+                    ca_fields.append((line[30:38], line[38:46], line[46:54], line[60:66]))
+                    residue_names.append(line[17:20])
+            elif line.startswith(b"ENDMDL"):
+                break
+    if not ca_fields:
+        return None
+    values = np.array(ca_fields, dtype="S8").astype(np.float64)
+    coordinates = np.ascontiguousarray(values[:, :3], dtype=dtype)
+    betas = np.ascontiguousarray(values[:, 3], dtype=dtype)
+    sequence = "".join(THREE_TO_ONE.get(r.decode(), "X") for r in residue_names)
+    atom_betas = np.array(atom_beta_fields, dtype="S8").astype(dtype) if all_atom_betas else None
+    return CAStructure(name, coordinates, betas, sequence, atom_betas)
@@ -1,53 +1,152 @@
+import gzip
+import io
+import multiprocessing
+from dataclasses import dataclass
+from functools import partial
+from pathlib import Path
 from portein import get_best_transformation, apply_transformation, find_size
 import prody as pd
-from geometricus import MomentInvariants, SplitType
+from scipy import sparse
 from scipy.signal import resample
+from scipy.spatial import cKDTree
 import numpy as np
 import matplotlib.pyplot as plt
+from matplotlib.collections import LineCollection
+from tqdm import tqdm
 
+from src import pdb_parser, archives, corpus, moments, make_data
 
-def get_coords_topic_scores(coords, topic_id, h_matrix_norm, shapemer_to_index):
-    def shapemer_to_topic_value(s_string):
-        if s_string in shapemer_to_index:
-            return h_matrix_norm[topic_id][shapemer_to_index[s_string]]
-        else:
-            return 0
-
-    resolution_kmer = 4
-    resolution_radius = 6
-    weights = np.zeros(coords.shape[0])
-    protein_invariants = MomentInvariants.from_coordinates("protein_id",
-                                                           coords,
-                                                           None,
-                                                           split_type=SplitType.KMER_CUT)
-
-    def get_similarity(x1, x2, gamma=0.03):
-        return np.exp(-gamma * np.sum((coords[x1] - coords[x2]) ** 2, axis=-1))
-
-    shapemers = (np.log1p(protein_invariants.moments) * resolution_kmer).astype(int)
-    for i, x in enumerate(shapemers):
-        weight = shapemer_to_topic_value(f"k{x[0]}i{x[1]}i{x[2]}i{x[3]}")
-        for index in range(i, i + 16):
-            weights[i] += weight * get_similarity(i, index)
-    protein_invariants = MomentInvariants.from_coordinates(
-        "protein_id",
-        coords,
-        None,
-        split_type=SplitType.RADIUS,
-        split_size=10)
-    shapemers = (np.log1p(protein_invariants.moments) * resolution_radius).astype(int)
-    for i, x in enumerate(shapemers):
-        weight = shapemer_to_topic_value(f"r{x[0]}i{x[1]}i{x[2]}i{x[3]}")
-        for index in protein_invariants.split_indices[i]:
-            weights[index] += weight * get_similarity(i, index)
+
+RESOLUTION_KMER = 4
+RESOLUTION_RADIUS = 6
+KMER_SIZE = 16
+RADIUS = 10
+
+
+@dataclass
+class TopicLookup:
+    """
+    Normalized topic weights of each shapemer, indexed by integer shapemer code (see `corpus.encode_shapemers`).
+    Build once per topic model and reuse for all proteins and topics.
+    """
+    vocabulary: np.ndarray
+    """sorted shapemer codes"""
+    weights: np.ndarray
+    """(len(vocabulary), n_topics)"""
+
+    @classmethod
+    def from_vocabulary(cls, h_matrix_norm, vocabulary):
+        """
+        From the sorted code vocabulary of a `corpus.ShapemerVectorizer`, matching the columns of h_matrix_norm
+        """
+        return cls(np.asarray(vocabulary, dtype=np.int64), np.ascontiguousarray(np.asarray(h_matrix_norm).T))
+
+    @classmethod
+    def from_shapemer_to_index(cls, h_matrix_norm, shapemer_to_index):
+        """
+        From a mapping of shapemer strings (e.g. k3i5i2i7) to columns of h_matrix_norm
+        """
+        codes = corpus.strings_to_codes(shapemer_to_index.keys())
+        columns = np.fromiter(shapemer_to_index.values(), dtype=np.int64, count=len(shapemer_to_index))
+        order = np.argsort(codes)
+        return cls(codes[order], np.ascontiguousarray(np.asarray(h_matrix_norm)[:, columns[order]].T))
+
+    def get_weights(self, codes: np.ndarray) -> np.ndarray:
+        """
+        (len(codes), n_topics) topic weights, zero for shapemers not in the vocabulary
+        """
+        rows = np.searchsorted(self.vocabulary, codes)
+        rows[rows == self.vocabulary.shape[0]] = 0
+        found = self.vocabulary[rows] == codes if self.vocabulary.shape[0] else np.zeros(len(codes), dtype=bool)
+        return np.where(found[:, None], self.weights[rows], 0.)
+
+
+def get_kmer_kernel(coords, gamma=0.03):
+    """
+    Summed similarity exp(-gamma * squared distance) of the first residue of each KMER_CUT fragment
+    to the KMER_SIZE residues starting at it.
+    """
+    num_kmers = coords.shape[0] - KMER_SIZE
+    if num_kmers <= 0:
+        return np.zeros(0)
+    windows = np.lib.stride_tricks.sliding_window_view(coords, KMER_SIZE, axis=0)[:num_kmers]
+    return np.exp(-gamma * np.sum((windows - coords[:num_kmers, :, None]) ** 2, axis=1)).sum(axis=1)
+
+
+def get_radius_kernel(coords, gamma=0.03):
+    """
+    (n_residues, n_residues) sparse similarity exp(-gamma * squared distance) of residues within RADIUS of each other,
+    column i holds the residues of the RADIUS fragment centered on residue i.
+    """
+    pairs = cKDTree(coords).query_pairs(RADIUS, output_type="ndarray")
+    rows = np.concatenate([pairs[:, 0], pairs[:, 1], np.arange(coords.shape[0])])
+    columns = np.concatenate([pairs[:, 1], pairs[:, 0], np.arange(coords.shape[0])])
+    values = np.exp(-gamma * np.sum((coords[rows] - coords[columns]) ** 2, axis=-1))
+    return sparse.csr_matrix((values, (rows, columns)), shape=(coords.shape[0], coords.shape[0]))
+
+
+def get_coords_topic_matrix(coords, lookup: TopicLookup, gamma=0.03):
+    """
+    (n_residues, n_topics) residue weights for all topics at once.
+
+    Each KMER_CUT shapemer adds its topic weight, scaled by the summed similarity of its first residue to its fragment,
+    to that first residue; each RADIUS shapemer adds its topic weight, scaled by similarity to the central residue,
+    to every residue of its fragment.
+    """
+    coords = np.asarray(coords, dtype=np.float64)
+    kmer_moments, radius_moments = make_data.get_coords_moments("protein_id", coords, None)
+    kmer_weights = lookup.get_weights(corpus.encode_shapemers(moments.discretize(kmer_moments, RESOLUTION_KMER)))
+    radius_weights = lookup.get_weights(corpus.encode_shapemers(moments.discretize(radius_moments, RESOLUTION_RADIUS),
+                                                                radius=True))
+    weights = get_radius_kernel(coords, gamma) @ radius_weights
+    weights[:kmer_weights.shape[0]] += get_kmer_kernel(coords, gamma)[:, None] * kmer_weights
     return weights
 
-def get_protein_topic_scores(path, topic_id, h_matrix_norm, shapemer_to_index, matplotlib=True):
-    pdb = pd.parsePDB(str(path))
-    pdb_alpha = pdb.select("protein and calpha")
-    opacities = pdb_alpha.getBetas() / 100
-    coords = pdb_alpha.getCoords()
-    weights = get_coords_topic_scores(coords, topic_id, h_matrix_norm, shapemer_to_index)
+
+def get_topic_matrices(coords_list, lookup: TopicLookup, gamma=0.03, num_workers=1):
+    """
+    `get_coords_topic_matrix` for many proteins, over `num_workers` processes.
+    """
+    function = partial(get_coords_topic_matrix, lookup=lookup, gamma=gamma)
+    if num_workers == 1:
+        return [function(coords) for coords in coords_list]
+    with multiprocessing.Pool(num_workers) as pool:
+        return pool.map(function, coords_list)
+
+
+def get_coords_topic_scores(coords, topic_id, h_matrix_norm, shapemer_to_index, lookup: TopicLookup = None):
+    """
+    Residue weights for topic `topic_id`, or all topics if it is None (see `get_coords_topic_matrix`).
+    Pass a precomputed `lookup` when scoring many proteins.
+    """
+    if lookup is None:
+        lookup = TopicLookup.from_shapemer_to_index(h_matrix_norm, shapemer_to_index)
+    weights = get_coords_topic_matrix(coords, lookup)
+    return weights if topic_id is None else weights[:, topic_id]
+
+def get_protein_topic_scores(path, topic_id, h_matrix_norm, shapemer_to_index, matplotlib=True,
+                             lookup: TopicLookup = None):
+    """
+    `path` is a model file, an `archives.TarMember` (see `archives.get_member_mapping`)
+    or, for matplotlib plots, an already read `pdb_parser.CAStructure` (e.g. from `coordinates.CoordinateStore.get_structure`)
+    """
+    if matplotlib:
+        if isinstance(path, pdb_parser.CAStructure):
+            pdb_alpha = path
+        else:
+            pdb_alpha = pdb_parser.parse_ca(path.read() if isinstance(path, archives.TarMember) else path,
+                                            dtype=np.float64)
+        opacities = pdb_alpha.betas / 100
+        coords = np.asarray(pdb_alpha.coordinates, dtype=np.float64)
+    else:
+        if isinstance(path, archives.TarMember):
+            pdb = pd.parsePDBStream(io.StringIO(gzip.decompress(path.read()).decode()))
+        else:
+            pdb = pd.parsePDB(str(path))
+        pdb_alpha = pdb.select("protein and calpha")
+        opacities = pdb_alpha.getBetas() / 100
+        coords = pdb_alpha.getCoords()
+    weights = get_coords_topic_scores(coords, topic_id, h_matrix_norm, shapemer_to_index, lookup)
     if matplotlib:
         coords = apply_transformation(coords, get_best_transformation(coords))
         return coords, weights, opacities
@@ -60,13 +159,67 @@ def get_protein_topic_scores(path, topic_id, h_matrix_norm, shapemer_to_index, m
 
 
 def plot_protein(coords, weights, opacities, max_value, upsample_rate=3):
+    """
+    Backbone trace in the xy plane as a single LineCollection, colored by weight (coolwarm, up to max_value)
+    and with per-segment opacity.
+    """
     coords = resample(coords[:, :2], upsample_rate * coords.shape[0])
     weights = np.repeat(weights, upsample_rate)
     opacities = np.repeat(opacities, upsample_rate)
-    colors = [plt.cm.coolwarm(int(256 * (x / max_value))) for x in weights]
+    num_segments = max(coords.shape[0] - upsample_rate, 0)
+    colors = plt.cm.coolwarm((256 * (weights[:num_segments] / max_value)).astype(int))
+    colors[:, 3] = opacities[:num_segments]
+    segments = np.stack([coords[:num_segments], coords[1:num_segments + 1]], axis=1)
     fig, ax = plt.subplots(figsize=find_size(coords, height=5, width=None))
-    for i in range(coords.shape[0] - upsample_rate):
-        ax.plot(coords[:, 0][i:i + 2], coords[:, 1][i:i + 2],
-                lw=2, color=colors[i], alpha=opacities[i])
+    ax.add_collection(LineCollection(segments, colors=colors, linewidths=2, capstyle="projecting"))
+    ax.autoscale_view()
     plt.axis("off")
     return fig, ax
+
+
+_RENDER_ARGUMENTS = {}
+
+
+def _init_renderer(lookup, max_value, output_folder, file_format, upsample_rate):
+    plt.switch_backend("Agg")
+    _RENDER_ARGUMENTS.update(lookup=lookup, max_value=max_value, output_folder=output_folder,
+                             file_format=file_format, upsample_rate=upsample_rate)
+
+
+def _render_protein(task):
+    key, source, topic_ids = task
+    arguments = _RENDER_ARGUMENTS
+    coords, weights, opacities = get_protein_topic_scores(source, None, None, None, lookup=arguments["lookup"])
+    filenames = []
+    for topic_id in topic_ids:
+        fig, _ = plot_protein(coords, weights[:, topic_id], opacities, arguments["max_value"],
+                              arguments["upsample_rate"])
+        filenames.append(arguments["output_folder"] / f"{key}_topic_{topic_id}.{arguments['file_format']}")
+        fig.savefig(filenames[-1], bbox_inches="tight")
+        plt.close(fig)
+    return filenames
+
+
+def render_protein_topics(pairs, sources, lookup: TopicLookup, output_folder, max_value,
+                          num_workers=1, file_format="png", upsample_rate=3):
+    """
+    Render `plot_protein` figures of (protein key, topic id) pairs to "<key>_topic_<topic id>.<file_format>" files,
+    over `num_workers` processes with the non-interactive Agg backend.
+    Each protein is read and scored for all topics once, however many of its pairs there are.
+
+    Parameters
+    ----------
+    sources
+        protein key to model file, `archives.TarMember` or `pdb_parser.CAStructure`
+    """
+    output_folder = Path(output_folder)
+    if not output_folder.exists():
+        output_folder.mkdir(parents=True)
+    topics = {}
+    for key, topic_id in pairs:
+        topics.setdefault(key, []).append(topic_id)
+    tasks = [(key, sources[key], topic_ids) for key, topic_ids in topics.items()]
+    with multiprocessing.Pool(num_workers, initializer=_init_renderer,
+                              initargs=(lookup, max_value, output_folder, file_format, upsample_rate)) as pool:
+        return [filename for filenames in tqdm(pool.imap(_render_protein, tasks), total=len(tasks))
+                for filename in filenames]
@@ -9,10 +9,12 @@ __license__ = "MIT"
 # !/usr/bin/python
 
 # imports
+import os
 import sys
 import re
+from pathlib import Path
+
 import numpy as np
-from itertools import groupby
 
 # Constants
 NUM_DIMENSIONS = 3
@@ -30,46 +32,144 @@ def letter_to_num(string, dict_):
     return [int(i) for i in num_string.split()]
 
 
-def yield_records_from_file(file, num_evo_entries: int = 20):
-    def get_record(lines):
-        entry = {"ID": lines[0].strip()}
-        for i, line in enumerate(lines):
-            if line == '[PRIMARY]' + '\n':
-                primary = lines[i + 1].strip()
-                entry.update({'primary': primary})
-            elif line == '[EVOLUTIONARY]' + '\n':
-                evolutionary = []
-                for residue in range(num_evo_entries):
-                    evolutionary.append(
-                        [float(step) for step in lines[i + 1].strip().split()]
-                    )
-                entry.update({'evolutionary': np.array(evolutionary)})
-            elif line == '[SECONDARY]' + '\n':
-                secondary = letter_to_num(lines[i + 1].strip(), _dssp_dict)
-                entry.update({'secondary': secondary})
-            elif line == '[TERTIARY]' + '\n':
-                tertiary = []
-                for axis in range(NUM_DIMENSIONS):
-                    tertiary.append([float(coord) for coord in lines[i + 1 + axis].strip().split()])
-                entry.update({'tertiary': np.array(tertiary).T})
-            elif line == '[MASK]' + '\n':
-                mask = letter_to_num(lines[i + 1].strip(), _mask_dict)
-                entry.update({'mask': mask})
-            else:
-                continue
-        return entry
-
-    for k, g in groupby(open(file, "r"), lambda x: x.startswith("[ID]")):
-        if not k:
-            yield get_record(list(g))
+FIELDS = ("primary", "evolutionary", "secondary", "tertiary", "mask")
+_SECTIONS = {b"[PRIMARY]": "primary", b"[EVOLUTIONARY]": "evolutionary", b"[SECONDARY]": "secondary",
+             b"[TERTIARY]": "tertiary", b"[MASK]": "mask"}
+
+
+def _get_lookup(dict_):
+    lookup = np.full(256, -1, dtype=np.int64)
+    for letter, number in dict_.items():
+        lookup[ord(letter)] = int(number)
+    return lookup
+
+
+_DSSP_LOOKUP = _get_lookup(_dssp_dict)
+_MASK_LOOKUP = _get_lookup(_mask_dict)
+
+
+def letters_to_array(line: bytes, lookup: np.ndarray) -> np.ndarray:
+    """ Vectorized letter_to_num, letters missing from lookup are skipped """
+    numbers = lookup[np.frombuffer(line, dtype=np.uint8)]
+    return numbers[numbers >= 0]
+
+
+def _parse_section(field, rows, num_evo_entries):
+    if field == "primary":
+        return rows[0].strip().decode()
+    if field == "secondary":
+        return letters_to_array(rows[0].strip(), _DSSP_LOOKUP)
+    if field == "mask":
+        return letters_to_array(rows[0].strip(), _MASK_LOOKUP)
+    if field == "evolutionary":
+        rows = rows[:num_evo_entries]
+    values = np.array(b" ".join(rows).split(), dtype=np.float64).reshape(len(rows), -1)
+    return values.T if field == "tertiary" else values
+
+
+def _parse_records(lines, fields, num_evo_entries):
+    """
+    Sections run from their [HEADER] line to the next line starting with "[",
+    lines of sections not in `fields` are only checked for that.
+    """
+    entry, field, rows = None, None, []
+    lines = iter(lines)
+    for line in lines:
+        if line.startswith(b"["):
+            if field is not None:
+                entry[field] = _parse_section(field, rows, num_evo_entries)
+            field, rows = None, []
+            header = line.strip()
+            if header == b"[ID]":
+                if entry is not None:
+                    yield entry
+                entry = {"ID": next(lines).strip().decode()}
+            elif _SECTIONS.get(header) in fields:
+                field = _SECTIONS[header]
+        elif field is not None and line.strip():
+            rows.append(line)
+    if field is not None:
+        entry[field] = _parse_section(field, rows, num_evo_entries)
+    if entry is not None:
+        yield entry
+
+
+def yield_records_from_file(file, num_evo_entries: int = 20, fields=FIELDS):
+    """
+    Yield ProteinNet records as dicts with "ID" and the requested `fields` (see FIELDS).
+    Lines of sections that are not requested are skipped without being parsed.
+
+    secondary and mask are integer arrays, evolutionary is (num_evo_entries, length)
+    and tertiary is (3 * length, 3) with N, CA and C coordinates of each residue.
+    """
+    with open(file, "rb") as f:
+        yield from _parse_records(f, fields, num_evo_entries)
+
+
+def get_index_file(file) -> Path:
+    return Path(f"{file}.index")
+
+
+def build_record_index(file) -> dict:
+    """
+    Byte offset of the [ID] line of each record in `file`, also written to its index file.
+    """
+    offsets = {}
+    offset = 0
+    with open(file, "rb") as f:
+        for line in f:
+            if line.strip() == b"[ID]":
+                record_offset = offset
+                offset += len(line)
+                line = next(f)
+                offsets[line.strip().decode()] = record_offset
+            offset += len(line)
+    index_file = get_index_file(file)
+    temporary_file = index_file.with_name(f"{index_file.name}.tmp")
+    with open(temporary_file, "w") as f:
+        for key, record_offset in offsets.items():
+            f.write(f"{key}\t{record_offset}\n")
+    os.replace(temporary_file, index_file)
+    return offsets
+
+
+def load_record_index(file) -> dict:
+    """
+    Record ID to byte offset in `file`.
+    The index file is (re)built if it does not exist or is older than `file`.
+    """
+    index_file = get_index_file(file)
+    if not index_file.exists() or index_file.stat().st_mtime < Path(file).stat().st_mtime:
+        return build_record_index(file)
+    with open(index_file) as f:
+        return {key: int(offset) for key, offset in (line.rstrip("\n").split("\t") for line in f)}
+
+
+def get_records(file, ids, num_evo_entries: int = 20, fields=FIELDS, index=None):
+    """
+    Yield the records with the given IDs, in file order, without scanning the rest of the file.
+
+    Parameters
+    ----------
+    index
+        output of load_record_index(file), loaded if not given
+    """
+    if index is None:
+        index = load_record_index(file)
+    with open(file, "rb") as f:
+        for offset in sorted(index[key] for key in ids):
+            f.seek(offset)
+            yield next(_parse_records(f, fields, num_evo_entries))
+
+
+def get_record(file, record_id: str, num_evo_entries: int = 20, fields=FIELDS, index=None):
+    return next(get_records(file, [record_id], num_evo_entries, fields, index))
 
 
 def clean_entry(entry, atom="ca"):
     sequence = "primary"
-    mask = np.where(np.array(entry['mask']) == 1)[0]
-    entry[sequence] = ''.join(entry[sequence][x] for x in mask)
-    mask_3d = np.array([i for n in mask for i in range(n*3, n*3+3)]).astype(int)
-    entry['tertiary'] = entry['tertiary'][mask_3d]
+    mask = np.where(np.asarray(entry['mask']) == 1)[0]
+    entry[sequence] = np.frombuffer(entry[sequence].encode(), dtype="S1")[mask].tobytes().decode()
     if atom == "ca":
         index = 1
     elif atom == "n":
@@ -78,6 +178,6 @@ def clean_entry(entry, atom="ca"):
         index = 2
     else:
         raise ValueError("atom must be one of n, ca, cb")
-    entry['tertiary'] = entry['tertiary'][np.arange(index, entry['tertiary'].shape[0]+index, 3)] / 100
+    entry['tertiary'] = entry['tertiary'][mask * 3 + index] / 100
     assert entry['tertiary'].shape[0] == len(entry[sequence]), (entry['tertiary'].shape[0], len(entry[sequence]))
     return entry
@@ -0,0 +1,117 @@
+"""
+Query-by-structure search in topic space.
+
+A query structure goes through the same pipeline as the AlphaFold models:
+high-confidence segments -> shapemers (`make_data.get_AF_file_shapemers`) -> TF-IDF (`vectorizer`)
+-> topic weights (`topic_model`) -> normalized topic weights (`scaler`),
+and its nearest neighbours among the normalized W matrix rows are found with an approximate
+nearest neighbour index (pynndescent), using the cosine metric as in the t-SNE embedding.
+"""
+
+import multiprocessing
+import pickle
+import typing as ty
+from dataclasses import dataclass
+from functools import partial
+from pathlib import Path
+
+import numpy as np
+from pynndescent import NNDescent
+
+from src import corpus, make_data
+
+
+@dataclass
+class SearchIndex:
+    keys: np.ndarray
+    index: NNDescent
+
+    def query(self, vectors: np.ndarray, k: int = 10,
+              epsilon: float = 0.1) -> ty.Tuple[np.ndarray, np.ndarray]:
+        """
+        Keys and cosine similarities of the `k` nearest neighbours of each row of `vectors`, most similar first.
+        A single (n_topics,) vector gives (k,) arrays, an (n_queries, n_topics) matrix gives (n_queries, k) arrays.
+        Larger `epsilon` searches more of the graph, more accurate but slower.
+        """
+        vectors = np.asarray(vectors, dtype=np.float32)
+        indices, distances = self.index.query(vectors.reshape(-1, vectors.shape[-1]), k=k, epsilon=epsilon)
+        keys, similarities = self.keys[indices], 1. - distances
+        if vectors.ndim == 1:
+            return keys[0], similarities[0]
+        return keys, similarities
+
+
+def build_search_index(w_matrix_norm: np.ndarray, keys: ty.Sequence[str], output_file: Path = None,
+                       n_neighbors: int = 30, random_state: int = 42, n_jobs: int = -1) -> SearchIndex:
+    """
+    Approximate nearest neighbour index over the rows of `w_matrix_norm` (one per key), cosine metric.
+    The search graph is prepared up front so the first query is as fast as the rest.
+    If `output_file` is given the index is pickled there, load it with `load_search_index`.
+    """
+    index = NNDescent(np.asarray(w_matrix_norm, dtype=np.float32), metric="cosine", n_neighbors=n_neighbors,
+                      random_state=random_state, n_jobs=n_jobs)
+    index.prepare()
+    search_index = SearchIndex(np.asarray(keys, dtype=str), index)
+    if output_file is not None:
+        with open(output_file, "wb") as f:
+            pickle.dump(search_index, f)
+    return search_index
+
+
+def load_search_index(index_file: Path) -> SearchIndex:
+    with open(index_file, "rb") as f:
+        return pickle.load(f)
+
+
+@dataclass
+class StructureSearcher:
+    """
+    Fitted models of the topic modelling notebook and a `SearchIndex` over its normalized W matrix.
+    """
+    vectorizer: corpus.ShapemerVectorizer
+    topic_model: ty.Any
+    """NMF or MiniBatchNMF"""
+    scaler: ty.Any
+    """StandardScaler fit on the W matrix"""
+    search_index: SearchIndex
+    resolution_kmer: int = 4
+    resolution_radius: int = 6
+    length_threshold: int = 50
+
+    def get_shapemers(self, sources: ty.Sequence, num_workers: int = 1) -> corpus.BinaryCorpus:
+        """
+        Shapemers of model files (or `archives.TarMember`s) as an in-memory corpus, see `make_data.get_AF_file_shapemers`.
+        """
+        process_function = partial(make_data.get_AF_file_shapemers,
+                                   resolution_kmer=self.resolution_kmer,
+                                   resolution_radius=self.resolution_radius,
+                                   length_threshold=self.length_threshold)
+        if num_workers > 1 and len(sources) > 1:
+            with multiprocessing.Pool(num_workers) as pool:
+                results = pool.map(process_function, sources)
+        else:
+            results = [process_function(source) for source in sources]
+        return corpus.get_memory_corpus([key for key, _ in results], [codes for _, codes in results])
+
+    def get_topic_vectors(self, query_corpus: corpus.BinaryCorpus) -> np.ndarray:
+        """
+        (n_documents, n_topics) normalized topic weights, comparable to the rows of the indexed W matrix
+        """
+        w_matrix = self.topic_model.transform(self.vectorizer.transform([query_corpus]))
+        return self.scaler.transform(w_matrix)
+
+    def search(self, sources: ty.Sequence, k: int = 10, epsilon: float = 0.1,
+               num_workers: int = 1) -> ty.Dict[str, ty.Tuple[np.ndarray, np.ndarray]]:
+        """
+        Key of each query structure to the keys and cosine similarities of its `k` nearest neighbours.
+        Structures without a long enough high-confidence segment have no shapemers and get empty results.
+        """
+        query_corpus = self.get_shapemers(sources, num_workers)
+        has_shapemers = np.diff(query_corpus.offsets) > 0
+        results = {str(key): (np.zeros(0, dtype=str), np.zeros(0, dtype=np.float32)) for key in query_corpus.ids}
+        if has_shapemers.any():
+            vectors = self.get_topic_vectors(query_corpus)[has_shapemers]
+            for key, neighbours, similarities in zip(query_corpus.ids[has_shapemers],
+                                                     *self.search_index.query(vectors, k, epsilon)):
+                results[str(key)] = (neighbours, similarities)
+        return results
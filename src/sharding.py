@@ -0,0 +1,160 @@
+"""
+Append-only, checkpointed output shards for resumable multi-process stages.
+"""
+
+import json
+import os
+import shutil
+import typing as ty
+from contextlib import contextmanager
+from pathlib import Path
+
+import numpy as np
+
+
+class Shard:
+    """
+    A set of append-only output streams for one unit of work (e.g. one proteome).
+
+    The checkpoint file records how many inputs have been processed and how many bytes each stream held at that point.
+    Opening a shard truncates every stream back to the last checkpoint, so an interrupted run resumes from there
+    without duplicated or half-written records.
+    """
+
+    def __init__(self, folder: Path, name: str, streams: ty.Sequence[str]):
+        self.folder = Path(folder)
+        self.name = name
+        self.paths = {stream: self.folder / f"{name}.{stream}" for stream in streams}
+        self.checkpoint_file = self.folder / f"{name}.checkpoint.json"
+        self.num_done = 0
+        self.complete = False
+        self._sizes = {}
+        self._handles = {}
+        if self.checkpoint_file.exists():
+            with open(self.checkpoint_file) as f:
+                checkpoint = json.load(f)
+            self.num_done = checkpoint["num_done"]
+            self.complete = checkpoint["complete"]
+            self._sizes = checkpoint["sizes"]
+            if set(self._sizes) != set(streams):
+                raise ValueError(f"{self.checkpoint_file} was written for streams {sorted(self._sizes)}, not {sorted(streams)}")
+
+    def __enter__(self):
+        if not self.folder.exists():
+            self.folder.mkdir(parents=True)
+        for stream, path in self.paths.items():
+            handle = open(path, "ab")
+            handle.truncate(self._sizes.get(stream, 0))
+            handle.seek(0, os.SEEK_END)
+            self._handles[stream] = handle
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        for handle in self._handles.values():
+            handle.close()
+        self._handles = {}
+
+    def write(self, stream: str, data: bytes):
+        self._handles[stream].write(data)
+
+    def checkpoint(self, num_done: int, complete: bool = False):
+        """
+        Flush all streams and atomically record `num_done` processed inputs.
+        """
+        for stream, handle in self._handles.items():
+            handle.flush()
+            os.fsync(handle.fileno())
+            self._sizes[stream] = handle.tell()
+        self.num_done = num_done
+        self.complete = complete
+        temporary_file = self.checkpoint_file.with_suffix(".tmp")
+        with open(temporary_file, "w") as f:
+            json.dump({"num_done": num_done, "complete": complete, "sizes": self._sizes}, f)
+        os.replace(temporary_file, self.checkpoint_file)
+
+
+@contextmanager
+def temporary_shard(folder: Path, name: str, streams: ty.Sequence[str]) -> ty.Iterator[Shard]:
+    """
+    Shard for a single-pass stage, whose streams are merged into the final output within the `with` block
+    and removed on exit (also if the stage fails):
+
+    >>> with temporary_shard(folder, "import", corpus.STREAMS) as shard:
+    ...     with shard:
+    ...         corpus.write_document(shard, key, codes)
+    ...     corpus.write_binary_corpus([shard], folder)
+    """
+    shard = Shard(folder, name, streams)
+    try:
+        yield shard
+    finally:
+        shard.__exit__(None, None, None)
+        for path in list(shard.paths.values()) + [shard.checkpoint_file]:
+            if path.exists():
+                path.unlink()
+
+
+def load_shards(folder: Path, complete_only: bool = True) -> ty.List[Shard]:
+    """
+    Shards in `folder`, found through their checkpoint files, sorted by name.
+    """
+    shards = []
+    for checkpoint_file in sorted(Path(folder).glob("*.checkpoint.json")):
+        with open(checkpoint_file) as f:
+            streams = list(json.load(f)["sizes"])
+        shard = Shard(folder, checkpoint_file.name[:-len(".checkpoint.json")], streams)
+        if shard.complete or not complete_only:
+            shards.append(shard)
+    return shards
+
+
+def merge_shards(shards: ty.Sequence[Shard], stream: str, output_file: Path, header: bytes = b""):
+    """
+    Concatenate one stream of each shard, in the given order, into `output_file`, after `header`.
+    """
+    with open(output_file, "wb") as f:
+        f.write(header)
+        for shard in shards:
+            with open(shard.paths[stream], "rb") as shard_file:
+                shutil.copyfileobj(shard_file, f)
+
+
+def read_shard_lines(shards: ty.Sequence[Shard], stream: str) -> ty.List[str]:
+    lines = []
+    for shard in shards:
+        with open(shard.paths[stream]) as f:
+            lines += f.read().splitlines()
+    return lines
+
+
+def read_shard_offsets(shards: ty.Sequence[Shard], lengths_stream: str) -> np.ndarray:
+    """
+    Offsets (n + 1,) from a stream of int64 lengths, e.g. the number of rows written for each document.
+    """
+    lengths = np.concatenate([np.zeros(0, dtype=np.int64)] +
+                             [np.fromfile(shard.paths[lengths_stream], dtype=np.int64) for shard in shards])
+    offsets = np.zeros(lengths.shape[0] + 1, dtype=np.int64)
+    np.cumsum(lengths, out=offsets[1:])
+    return offsets
+
+
+def save_shard_array(shards: ty.Sequence[Shard], stream: str, output_file: Path, dtype, row_shape: tuple = ()):
+    """
+    Concatenate a stream of raw `dtype` values of each shard, in the given order, into one .npy file
+    with rows of shape `row_shape`, without holding more than one shard in memory.
+    """
+    arrays = [np.memmap(shard.paths[stream], dtype=dtype, mode="r") if shard.paths[stream].stat().st_size
+              else np.zeros(0, dtype=dtype) for shard in shards]
+    row_size = int(np.prod(row_shape))
+    num_rows = sum(array.shape[0] for array in arrays) // row_size
+    if num_rows == 0:
+        np.save(output_file, np.zeros((0,) + tuple(row_shape), dtype=dtype))
+        return
+    output = np.lib.format.open_memmap(output_file, mode="w+", dtype=dtype, shape=(num_rows,) + tuple(row_shape))
+    flat_output = output.reshape(-1)
+    start = 0
+    for array in arrays:
+        flat_output[start: start + array.shape[0]] = array
+        start += array.shape[0]
+    output.flush()
+    del flat_output, output
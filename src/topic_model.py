@@ -0,0 +1,121 @@
+"""
+Out-of-core topic model training.
+
+The vocabulary and IDF weights are fixed once (from all corpora, or a representative subset),
+TF-IDF rows are computed in chunks and fed to MiniBatchNMF.partial_fit.
+The model is checkpointed after every corpus (e.g. one proteome shard), so training resumes after interruptions
+and new proteomes can be absorbed into a trained model without refitting from scratch.
+"""
+
+import os
+import pickle
+import typing as ty
+from dataclasses import dataclass, field
+from pathlib import Path
+
+import numpy as np
+from sklearn.decomposition import MiniBatchNMF
+from tqdm import tqdm
+
+from src import corpus
+from src.sharding import load_shards
+
+CHECKPOINT_FILE = "topic_model.pkl"
+
+
+@dataclass
+class TopicModelCheckpoint:
+    vectorizer: corpus.ShapemerVectorizer
+    topic_model: MiniBatchNMF
+    trained: ty.List[str] = field(default_factory=list)
+    """names of the corpora the model has been updated with, in order"""
+
+
+def save_checkpoint(checkpoint: TopicModelCheckpoint, model_folder: Path):
+    model_folder = Path(model_folder)
+    if not model_folder.exists():
+        model_folder.mkdir(parents=True)
+    temporary_file = model_folder / f"{CHECKPOINT_FILE}.tmp"
+    with open(temporary_file, "wb") as f:
+        pickle.dump(checkpoint, f)
+    os.replace(temporary_file, model_folder / CHECKPOINT_FILE)
+
+
+def load_checkpoint(model_folder: Path) -> ty.Union[TopicModelCheckpoint, None]:
+    checkpoint_file = Path(model_folder) / CHECKPOINT_FILE
+    if not checkpoint_file.exists():
+        return None
+    with open(checkpoint_file, "rb") as f:
+        return pickle.load(f)
+
+
+def get_shard_corpora(shard_folder: Path) -> ty.Dict[str, corpus.BinaryCorpus]:
+    """
+    Shard name (proteome) to memory-mapped corpus, for all complete shards in `shard_folder`
+    (e.g. the output folder of `make_data.scan_AF_structures`), sorted by name.
+    """
+    return {shard.name: corpus.load_shard_corpus(shard) for shard in load_shards(shard_folder)}
+
+
+def train_topic_model(model_folder: Path,
+                      corpora: ty.Dict[str, corpus.BinaryCorpus],
+                      vectorizer: corpus.ShapemerVectorizer = None,
+                      num_topics: int = 250,
+                      batch_size: int = 2048,
+                      num_epochs: int = 1,
+                      min_df: int = 2,
+                      **nmf_kwargs) -> TopicModelCheckpoint:
+    """
+    Update the checkpointed model in `model_folder` with every corpus it has not seen yet, in the given order,
+    `batch_size` TF-IDF rows per MiniBatchNMF.partial_fit step and `num_epochs` passes over each new corpus.
+
+    Without a checkpoint a new model is started: the vocabulary and IDF weights come from `vectorizer`
+    if given (already fit, e.g. on a subset) or are fit on all `corpora` with `min_df`,
+    and MiniBatchNMF is created with `num_topics` components and `nmf_kwargs`.
+    The vocabulary stays fixed afterwards, shapemers of later corpora that are not in it are ignored.
+
+    Parameters
+    ----------
+    corpora
+        corpus name (e.g. proteome, see `get_shard_corpora`) to BinaryCorpus
+    """
+    checkpoint = load_checkpoint(model_folder)
+    if checkpoint is None:
+        if vectorizer is None:
+            vectorizer = corpus.ShapemerVectorizer(min_df=min_df).fit(list(corpora.values()))
+        checkpoint = TopicModelCheckpoint(vectorizer, MiniBatchNMF(n_components=num_topics, batch_size=batch_size,
+                                                                   **nmf_kwargs))
+    for name, c in corpora.items():
+        if name in checkpoint.trained:
+            continue
+        for _ in range(num_epochs):
+            for tfidf_chunk in tqdm(checkpoint.vectorizer.iter_transform([c], batch_size),
+                                    total=-(-len(c) // batch_size), desc=name):
+                checkpoint.topic_model.partial_fit(tfidf_chunk)
+        checkpoint.trained.append(name)
+        save_checkpoint(checkpoint, model_folder)
+    return checkpoint
+
+
+def transform_corpora(checkpoint: TopicModelCheckpoint,
+                      corpora: ty.Sequence[corpus.BinaryCorpus],
+                      output_file: Path = None,
+                      chunk_size: int = 10_000) -> np.ndarray:
+    """
+    W matrix (n_documents, n_topics) of `corpora`, computed `chunk_size` documents at a time.
+    If `output_file` is given it is written there as a .npy file and returned memory-mapped.
+    """
+    num_documents = sum(len(c) for c in corpora)
+    shape = (num_documents, checkpoint.topic_model.n_components_)
+    if output_file is None:
+        w_matrix = np.zeros(shape)
+    else:
+        w_matrix = np.lib.format.open_memmap(output_file, mode="w+", dtype=np.float64, shape=shape)
+    start = 0
+    for tfidf_chunk in tqdm(checkpoint.vectorizer.iter_transform(corpora, chunk_size),
+                            total=sum(-(-len(c) // chunk_size) for c in corpora)):
+        w_matrix[start: start + tfidf_chunk.shape[0]] = checkpoint.topic_model.transform(tfidf_chunk)
+        start += tfidf_chunk.shape[0]
+    if output_file is not None:
+        w_matrix.flush()
+    return w_matrix
@@ -1,11 +1,31 @@
+import sqlite3
+import time
+import typing as ty
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from functools import lru_cache
+
 import requests
+from requests.adapters import HTTPAdapter
 from tqdm import tqdm
 from pathlib import Path
 
+MAPPING_URL = "http://www.uniprot.org/uploadlists/"
+DBXREF_URL = "https://www.uniprot.org/docs/dbxref.txt"
+
+
 # Cross References
-DB_ABBREVS = ["database(EMBL)"] + ["database(" + line.strip().split(": ")[1] + ")" for line in
-                                   requests.get("https://www.uniprot.org/docs/dbxref.txt").text.split("\n") if
-                                   "Abbrev:" in line]
+@lru_cache()
+def get_db_abbrevs(url: str = DBXREF_URL) -> ty.List[str]:
+    return ["database(EMBL)"] + ["database(" + line.strip().split(": ")[1] + ")" for line in
+                                 requests.get(url).text.split("\n") if "Abbrev:" in line]
+
+
+def __getattr__(name):
+    # DB_ABBREVS is fetched on first use rather than at import
+    if name == "DB_ABBREVS":
+        return get_db_abbrevs()
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
 
 COLUMN_NAMES = [
     # Names & Taxonomy
@@ -88,8 +108,99 @@ COLUMN_NAMES = [
     'lineage-id(FORMA)']
 
 
+class UniprotCache:
+    """
+    sqlite file with the response rows of each queried ID, keyed by (ID, identifier, to, columns).
+    IDs that returned no rows are stored too, so they are not queried again.
+    """
+
+    def __init__(self, filename: Path):
+        self.connection = sqlite3.connect(str(filename))
+        self.connection.execute("CREATE TABLE IF NOT EXISTS headers "
+                                "(identifier TEXT, target TEXT, columns TEXT, header TEXT, "
+                                "PRIMARY KEY (identifier, target, columns))")
+        self.connection.execute("CREATE TABLE IF NOT EXISTS rows "
+                                "(id TEXT, identifier TEXT, target TEXT, columns TEXT, rows TEXT, "
+                                "PRIMARY KEY (id, identifier, target, columns))")
+
+    def get_header(self, identifier: str, to: str, columns: str) -> ty.Union[str, None]:
+        result = self.connection.execute("SELECT header FROM headers WHERE identifier=? AND target=? AND columns=?",
+                                         (identifier, to, columns)).fetchone()
+        return None if result is None else result[0]
+
+    def get_rows(self, ids: ty.List[str], identifier: str, to: str, columns: str) -> ty.Dict[str, ty.List[str]]:
+        rows = {}
+        for i in range(0, len(ids), 500):
+            id_chunk = ids[i: i + 500]
+            for key, text in self.connection.execute(
+                    f"SELECT id, rows FROM rows WHERE identifier=? AND target=? AND columns=? "
+                    f"AND id IN ({','.join('?' * len(id_chunk))})", [identifier, to, columns] + id_chunk):
+                rows[key] = text.split("\n") if text else []
+        return rows
+
+    def add(self, identifier: str, to: str, columns: str, header: str, rows: ty.Dict[str, ty.List[str]]):
+        with self.connection:
+            if header is not None:
+                self.connection.execute("INSERT OR IGNORE INTO headers VALUES (?, ?, ?, ?)",
+                                        (identifier, to, columns, header))
+            self.connection.executemany("INSERT OR REPLACE INTO rows VALUES (?, ?, ?, ?, ?)",
+                                        [(key, identifier, to, columns, "\n".join(key_rows))
+                                         for key, key_rows in rows.items()])
+
+    def close(self):
+        self.connection.close()
+
+
+def get_session(num_connections: int = 4) -> requests.Session:
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=num_connections, pool_maxsize=num_connections)
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+    return session
+
+
+def query_uniprot(session: requests.Session, ids: ty.List[str], params: dict, url: str = MAPPING_URL,
+                  num_tries: int = 5, backoff: float = 1.) -> str:
+    """
+    POST one query, retrying with exponential backoff (backoff, 2 * backoff, ... seconds)
+    on connection errors, error status codes and HTML (error page) responses.
+    """
+    for try_number in range(num_tries):
+        try:
+            response = session.post(url, params=dict(params, query=" ".join(ids)))
+            if response.ok and "<html><head>" not in response.text:
+                return response.text
+            error = f"status {response.status_code}" if not response.ok else "HTML response"
+        except requests.RequestException as e:
+            error = type(e).__name__
+        if try_number < num_tries - 1:
+            time.sleep(backoff * 2 ** try_number)
+    raise RuntimeError(f"UniProt query for {len(ids)} IDs starting with {ids[0]} failed {num_tries} times, last: {error}")
+
+
+def split_response(text: str, ids: ty.List[str]) -> ty.Tuple[str, ty.Dict[str, ty.List[str]]]:
+    """
+    Header line and the rows of each queried ID.
+    Rows are assigned to IDs with the "yourlist" column (the input IDs a row was mapped from) if present,
+    otherwise with the first column, and IDs without rows get an empty list.
+    """
+    id_rows = {key: [] for key in ids}
+    lines = [line for line in text.split("\n") if line]
+    if not lines:
+        return None, id_rows
+    header, *rows = lines
+    columns = header.split("\t")
+    id_column = next((i for i, c in enumerate(columns) if c.startswith("yourlist")), 0)
+    for row in rows:
+        for key in row.split("\t")[id_column].split(","):
+            if key in id_rows:
+                id_rows[key].append(row)
+    return header, id_rows
+
+
 def get_uniprot_info_from_ids(ids: list, filename: Path, chunk=False, identifier: str = "ACC+ID", to: str = "ACC",
-                              columns: str = ",".join(COLUMN_NAMES)):
+                              columns: str = ",".join(COLUMN_NAMES), cache_file: Path = None, num_workers: int = 4,
+                              chunk_size: int = 100, num_tries: int = 5, backoff: float = 1., url: str = MAPPING_URL):
     """
     Batch retrieval of IDs and information from UniProt.
 
@@ -100,48 +211,65 @@ def get_uniprot_info_from_ids(ids: list, filename: Path, chunk=False, identifier
     filename
         write to this file
     chunk
-        split into multiple queries of size 100 and join results
+        split into multiple queries of size chunk_size, sent concurrently, and join results
     identifier
         type of input IDs
     to
         output ID format - ACC returns all column information
     columns
         column names to return, preformatted sting (",".join(column_names))
-
+    cache_file
+        sqlite file of earlier responses (see UniprotCache), only IDs missing from it are queried
+    num_workers
+        number of concurrent queries, sharing one pooled session
+    num_tries
+        number of attempts per query, with exponential backoff starting at `backoff` seconds
+    url
+        mapping service URL, e.g. of a local stand-in server
 
     Returns
     -------
-    All information written as newline separated, tab delimited text.
+    All information written as newline separated, tab delimited text, rows in the order of `ids`.
+    Raises a RuntimeError, without writing `filename`, if a query still fails after `num_tries` attempts
+    or no response (nor the cache) had a header line; with a cache the successful queries are kept for the next run.
     """
-    mapping_url = 'http://www.uniprot.org/uploadlists/'
     mapping_params = {
         'from': identifier,
         'to': to,
         'format': 'tab',
         'columns': columns
     }
+    ids = list(dict.fromkeys(ids))
+    cache = UniprotCache(cache_file) if cache_file is not None else None
+    try:
+        header = cache.get_header(identifier, to, columns) if cache is not None else None
+        id_rows = cache.get_rows(ids, identifier, to, columns) if cache is not None else {}
+        missing = [key for key in ids if key not in id_rows]
+        if not chunk:
+            chunk_size = max(len(missing), 1)
+        id_chunks = [missing[i: i + chunk_size] for i in range(0, len(missing), chunk_size)]
+        failures = []
+        with get_session(num_workers) as session, ThreadPoolExecutor(num_workers) as executor:
+            futures = {executor.submit(query_uniprot, session, id_chunk, mapping_params, url, num_tries, backoff): id_chunk
+                       for id_chunk in id_chunks}
+            for future in tqdm(as_completed(futures), total=len(futures)):
+                try:
+                    chunk_header, chunk_rows = split_response(future.result(), futures[future])
+                except RuntimeError as e:
+                    failures.append(e)
+                    continue
+                header = header or chunk_header
+                id_rows.update(chunk_rows)
+                # an empty (header-less) response is not cached, so its IDs are queried again next time
+                if cache is not None and chunk_header is not None:
+                    cache.add(identifier, to, columns, chunk_header, chunk_rows)
+    finally:
+        if cache is not None:
+            cache.close()
+    if failures:
+        raise RuntimeError(f"{len(failures)} of {len(id_chunks)} UniProt queries failed, first: {failures[0]}")
+    if header is None:
+        raise RuntimeError(f"UniProt returned no header for {len(ids)} IDs, {filename} not written")
+    rows = dict.fromkeys(row for key in ids for row in id_rows[key])
     with open(filename, "w") as f:
-        if chunk:
-            num_tries = 5
-            for i, id_i in tqdm(enumerate(range(0, len(ids), 100))):
-                id_chunk = ids[id_i: id_i + 100]
-                good_text = False
-                text = ""
-                try_number = 0
-                while not good_text and try_number < num_tries:
-                    mapping_params['query'] = ' '.join(id_chunk)
-                    response = requests.post(mapping_url, params=mapping_params)
-                    text = response.text
-                    if "<html><head>" in text:
-                        good_text = False
-                    else:
-                        good_text = True
-                    try_number += 1
-                if i == 0:
-                    f.write(text)
-                else:
-                    f.write("\n".join(text.split("\n")[1:]))
-        else:
-            mapping_params['query'] = ' '.join(ids)
-            response = requests.post(mapping_url, params=mapping_params)
-            f.write(response.text)
+        f.write("\n".join([header] + list(rows)) + "\n")